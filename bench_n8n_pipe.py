@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+bench_n8n_pipe.py
+
+Load-test harness for n8n_pipe.Pipe that needs no live n8n:
+1. Starts a local stub webhook with configurable latency, jitter, errors and payload size
+2. Drives Pipe.pipe with many concurrent simulated Open WebUI requests
+3. Reports throughput, p50/p95/p99 latency and event loop lag
+4. Optionally fails (exit code 1) when results cross regression thresholds
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from typing import Dict, List
+
+from aiohttp import web
+
+from n8n_pipe import Pipe
+
+class StubWebhook:
+    """A stand-in for an n8n webhook with controllable behaviour."""
+
+    def __init__(self, latency: float, jitter: float, error_rate: float,
+                 payload_size: int, stream: bool, chunks: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.payload_size = payload_size
+        self.stream = stream
+        self.chunks = max(chunks, 1)
+        self.calls = 0
+        self.runner = None
+
+    def delay(self) -> float:
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.calls += 1
+        body = await request.json()
+        if random.random() < self.error_rate:
+            await asyncio.sleep(self.delay())
+            return web.Response(status=500, text="stub error")
+        answer = f"Answer to {body.get('chatInput', '')}: "
+        answer += "x" * max(self.payload_size - len(answer), 0)
+        if not self.stream:
+            await asyncio.sleep(self.delay())
+            return web.json_response({"output": answer})
+
+        # Mimic n8n's streaming webhook: one JSON item per line
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+        await response.write(b'{"type": "begin"}\n')
+        step = -(-len(answer) // self.chunks)
+        for start in range(0, len(answer), step):
+            await asyncio.sleep(self.delay() / self.chunks)
+            item = {"type": "item", "content": answer[start:start + step]}
+            await response.write(json.dumps(item).encode("utf-8") + b"\n")
+        await response.write(b'{"type": "end"}\n')
+        await response.write_eof()
+        return response
+
+    async def start(self, host: str, port: int) -> str:
+        app = web.Application()
+        app.router.add_post("/webhook/stub", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        port = self.runner.addresses[0][1]
+        return f"http://{host}:{port}/webhook/stub"
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes a sleeping task."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self.task = None
+
+    async def run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(time.perf_counter() - started - self.interval)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+def make_event_emitter(chat_id: str, events: List[dict]):
+    # Pipe reads chat_id from the emitter's closure, as Open WebUI builds it
+    request_info = {"chat_id": chat_id, "message_id": f"{chat_id}-message"}
+
+    async def event_emitter(event: dict):
+        events.append({"request": request_info["chat_id"], **event})
+
+    return event_emitter
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+def parse_valve(text: str):
+    name, _, value = text.partition("=")
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+async def run_benchmark(args) -> Dict:
+    stub = StubWebhook(args.latency, args.jitter, args.error_rate,
+                       args.payload_size, args.stream, args.chunks)
+    url = await stub.start(args.host, args.port)
+
+    pipe = Pipe()
+    valves = {"n8n_url": url, "stream": args.stream, "emit_interval": 1.0}
+    valves.update(dict(parse_valve(item) for item in args.valve))
+    pipe.valves = pipe.Valves(**valves)
+
+    latencies: List[float] = []
+    first_tokens: List[float] = []
+    events: List[dict] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one_request(index: int):
+        nonlocal errors
+        # A share of requests repeat earlier questions to exercise caching/coalescing
+        if index and random.random() < args.duplicate_rate:
+            question = f"question {random.randrange(index)}"
+        else:
+            question = f"question {index}"
+        if random.random() < args.nocache_rate:
+            question = f"{pipe.valves.cache_bypass_prefix} {question}"
+        body = {"messages": [{"role": "user", "content": question}]}
+        emitter = make_event_emitter(f"chat-{index}", events)
+        user = {"id": f"user-{index % args.users}"}
+        async with semaphore:
+            started = time.perf_counter()
+            result = await pipe.pipe(body, __user__=user, __event_emitter__=emitter)
+            if hasattr(result, "__aiter__"):
+                first_token = None
+                async for _ in result:
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                if first_token is not None:
+                    first_tokens.append(first_token)
+                else:
+                    errors += 1
+            elapsed = time.perf_counter() - started
+        if isinstance(result, dict) and "error" in result:
+            errors += 1
+        latencies.append(elapsed)
+
+    monitor = LoopLagMonitor()
+    monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(one_request(index) for index in range(args.requests)))
+    duration = time.perf_counter() - started
+    await monitor.stop()
+    endpoints = pipe.endpoint_stats()
+    await pipe.on_shutdown()
+    await stub.stop()
+
+    report = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "errors": errors,
+        "upstream_calls": stub.calls,
+        "duration_s": duration,
+        "throughput_rps": args.requests / duration if duration else 0.0,
+        "latency_p50_s": percentile(latencies, 0.50),
+        "latency_p95_s": percentile(latencies, 0.95),
+        "latency_p99_s": percentile(latencies, 0.99),
+        "loop_lag_p99_ms": percentile(monitor.samples, 0.99) * 1000,
+        "loop_lag_max_ms": max(monitor.samples, default=0.0) * 1000,
+        "status_events": len(events),
+        "endpoints": endpoints,
+    }
+    if args.stream:
+        report["first_token_p50_s"] = percentile(first_tokens, 0.50)
+        report["first_token_p95_s"] = percentile(first_tokens, 0.95)
+    return report
+
+def check_thresholds(report: Dict, args) -> List[str]:
+    failures = []
+    if args.max_p95 is not None and report["latency_p95_s"] > args.max_p95:
+        failures.append(f"p95 latency {report['latency_p95_s']:.3f}s > {args.max_p95}s")
+    if args.min_throughput is not None and report["throughput_rps"] < args.min_throughput:
+        failures.append(f"throughput {report['throughput_rps']:.1f} req/s < {args.min_throughput} req/s")
+    if args.max_loop_lag is not None and report["loop_lag_p99_ms"] > args.max_loop_lag:
+        failures.append(f"event loop lag p99 {report['loop_lag_p99_ms']:.1f}ms > {args.max_loop_lag}ms")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark n8n_pipe.Pipe against a local stub webhook.')
+    parser.add_argument('--requests', type=int, default=500, help='Total requests to send (default: 500)')
+    parser.add_argument('--concurrency', type=int, default=100, help='Requests in flight at once (default: 100)')
+    parser.add_argument('--users', type=int, default=50, help='Distinct simulated users (default: 50)')
+    parser.add_argument('--latency', type=float, default=0.2, help='Stub workflow latency in seconds (default: 0.2)')
+    parser.add_argument('--jitter', type=float, default=0.05, help='Random +/- latency jitter in seconds (default: 0.05)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of stub calls answering HTTP 500 (default: 0)')
+    parser.add_argument('--payload-size', type=int, default=2048, help='Answer size in bytes (default: 2048)')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0, help='Fraction of requests repeating an earlier question (default: 0)')
+    parser.add_argument('--nocache-rate', type=float, default=0.0, help='Fraction of requests sent with the cache bypass prefix (default: 0)')
+    parser.add_argument('--stream', action='store_true', help='Serve NDJSON streaming responses and enable the stream valve')
+    parser.add_argument('--chunks', type=int, default=20, help='Chunks per streamed answer (default: 20)')
+    parser.add_argument('--valve', action='append', default=[], metavar='NAME=VALUE',
+                      help='Override a Pipe valve, e.g. --valve max_concurrency=8 (repeatable)')
+    parser.add_argument('--host', default='127.0.0.1', help='Stub webhook bind address (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=0, help='Stub webhook port (default: any free port)')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    parser.add_argument('--max-p95', type=float, help='Fail if p95 latency exceeds this many seconds')
+    parser.add_argument('--min-throughput', type=float, help='Fail if throughput is below this many requests/s')
+    parser.add_argument('--max-loop-lag', type=float, help='Fail if p99 event loop lag exceeds this many ms')
+    args = parser.parse_args()
+
+    report = asyncio.run(run_benchmark(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            if key == "endpoints":
+                for endpoint in value:
+                    latency = "n/a" if endpoint["latency"] is None else f"{endpoint['latency']:.3f}s"
+                    print(f"{'endpoint':>20}: {endpoint['url']} {endpoint['state']}, "
+                          f"{endpoint['successes']} ok, {endpoint['failures']} failed, latency {latency}")
+                continue
+            print(f"{key:>20}: {value:.3f}" if isinstance(value, float) else f"{key:>20}: {value}")
+
+    failures = check_thresholds(report, args)
+    for failure in failures:
+        print(f"[FAIL] {failure}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+bench_ollama_models.py
+
+Compares the models installed in a local Ollama to pick the ones the stack pins:
+1. Runs every chat model through the same short-answer prompts and every embedding
+   model through the same retrieval set, one model loaded at a time
+2. Records load time, resident memory, prompt-eval and generation tokens/s
+3. Scores chat answers by their agreement with a reference model and embeddings
+   by how often a query retrieves its own passage
+4. Prints a ranked table per kind of model, optionally as JSON
+"""
+
+import argparse
+import json
+import math
+import re
+import sys
+import time
+from collections import Counter
+from typing import Dict, List
+
+import requests
+
+# Short, unambiguous answers, so that agreement between models can be scored
+PROMPTS = [
+    "What is the capital of Australia? Answer with the city name only.",
+    "How many days are in a leap year? Answer with a number only.",
+    "Which planet is known as the Red Planet? Answer in one word.",
+    "What is the chemical symbol for gold? Answer with the symbol only.",
+    "Who wrote 'Pride and Prejudice'? Answer with the author's name only.",
+    "What is 17 multiplied by 6? Answer with a number only.",
+    "In which year did the Berlin Wall fall? Answer with the year only.",
+    "Which data structure works first in, first out? Answer in one word.",
+    "Name the SQL command that removes all rows from a table but keeps the table. One word.",
+    "What does HTTP status code 404 mean? Answer in at most five words.",
+]
+
+# Each query should retrieve the passage at the same position
+RETRIEVAL = [
+    ("How do I reset my password?",
+     "To change a forgotten password, open the login page and follow the 'Forgot password' link."),
+    ("What are the opening hours on weekends?",
+     "On Saturdays and Sundays the office is open from 10am until 4pm."),
+    ("Can I get a refund for a cancelled order?",
+     "Orders cancelled before shipping are reimbursed in full within five working days."),
+    ("Which ports does the database listen on?",
+     "Postgres accepts connections on 5432, and the connection pooler on 6543."),
+    ("How much memory does the language model need?",
+     "The 7B model quantised to 4 bits needs roughly 5 GB of RAM once loaded."),
+    ("Where are uploaded files stored?",
+     "Attachments are written to the shared volume mounted at /data/shared."),
+    ("Who do I contact about an invoice error?",
+     "Billing mistakes are handled by the accounts team at accounts@example.com."),
+    ("Is there a limit on API requests?",
+     "Each API key may send up to 600 calls per minute before being throttled."),
+]
+
+class Ollama:
+    """A thin client for the parts of the Ollama API the benchmark needs."""
+
+    def __init__(self, url: str, timeout: float):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def get(self, path: str) -> Dict:
+        response = self.session.get(self.url + path, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def post(self, path: str, payload: Dict) -> Dict:
+        response = self.session.post(self.url + path, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def models(self) -> List[Dict]:
+        return self.get('/api/tags').get('models', [])
+
+    def loaded(self) -> Dict[str, Dict]:
+        return {m['name']: m for m in self.get('/api/ps').get('models', [])}
+
+    def unload(self, model: str):
+        self.post('/api/generate', {'model': model, 'keep_alive': 0})
+
+def is_embedding(client: Ollama, model: str) -> bool:
+    """Tell embedding models apart, from their capabilities or their architecture."""
+    info = client.post('/api/show', {'model': model})
+    if info.get('capabilities'):
+        return 'embedding' in info['capabilities']
+    family = (info.get('details') or {}).get('family', '')
+    return 'bert' in family or 'embed' in model
+
+def words(text: str) -> List[str]:
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+def agreement(answer: str, reference: str) -> float:
+    """Token F1 between two answers, as used for extractive QA."""
+    a, b = words(answer), words(reference)
+    if not a or not b:
+        return float(a == b)
+    common = sum((Counter(a) & Counter(b)).values())
+    if not common:
+        return 0.0
+    precision, recall = common / len(a), common / len(b)
+    return 2 * precision * recall / (precision + recall)
+
+def cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+def load(client: Ollama, model: str, embedding: bool) -> Dict:
+    """Load a model from cold and report how long it took and what it occupies."""
+    started = time.perf_counter()
+    if embedding:
+        response = client.post('/api/embed', {'model': model, 'input': 'load'})
+    else:
+        response = client.post('/api/generate', {'model': model, 'prompt': ''})
+    elapsed = time.perf_counter() - started
+    resident = client.loaded().get(model, {})
+    size = resident.get('size', 0)
+    return {
+        # Ollama's own figure excludes the HTTP round trip
+        "load_s": response.get('load_duration', elapsed * 1e9) / 1e9,
+        "memory_gb": size / 1024 ** 3,
+        "gpu_share": resident.get('size_vram', 0) / size if size else 0.0,
+    }
+
+def bench_chat(client: Ollama, model: str, tokens: int) -> Dict:
+    result = load(client, model, embedding=False)
+    answers = []
+    prompt_tokens = prompt_ns = eval_tokens = eval_ns = 0
+    for prompt in PROMPTS:
+        response = client.post('/api/generate', {
+            'model': model, 'prompt': prompt, 'stream': False,
+            'options': {'temperature': 0, 'seed': 42, 'num_predict': tokens},
+        })
+        answers.append(response.get('response', '').strip())
+        prompt_tokens += response.get('prompt_eval_count', 0)
+        prompt_ns += response.get('prompt_eval_duration', 0)
+        eval_tokens += response.get('eval_count', 0)
+        eval_ns += response.get('eval_duration', 0)
+    result.update({
+        "prompt_tokens_per_s": prompt_tokens / prompt_ns * 1e9 if prompt_ns else 0.0,
+        "generation_tokens_per_s": eval_tokens / eval_ns * 1e9 if eval_ns else 0.0,
+        "answers": answers,
+    })
+    return result
+
+def bench_embedding(client: Ollama, model: str) -> Dict:
+    result = load(client, model, embedding=True)
+    queries = [query for query, _ in RETRIEVAL]
+    passages = [passage for _, passage in RETRIEVAL]
+    response = client.post('/api/embed', {'model': model, 'input': queries + passages})
+    vectors = response.get('embeddings', [])
+    query_vectors, passage_vectors = vectors[:len(queries)], vectors[len(queries):]
+    hits = 0
+    for index, query in enumerate(query_vectors):
+        scores = [cosine(query, passage) for passage in passage_vectors]
+        hits += scores.index(max(scores)) == index
+    total_ns = response.get('total_duration', 0)
+    result.update({
+        "prompt_tokens_per_s": response.get('prompt_eval_count', 0) / total_ns * 1e9 if total_ns else 0.0,
+        "texts_per_s": len(queries + passages) / total_ns * 1e9 if total_ns else 0.0,
+        "retrieval_accuracy": hits / len(RETRIEVAL) if query_vectors else 0.0,
+        "dimensions": len(vectors[0]) if vectors else 0,
+    })
+    return result
+
+def run_benchmark(args) -> Dict:
+    client = Ollama(args.url, args.timeout)
+    installed = {m['name']: m.get('size', 0) for m in client.models()}
+    models = args.model or sorted(installed)
+    missing = [model for model in models if model not in installed]
+    if missing:
+        raise SystemExit(f"Not installed in Ollama: {', '.join(missing)}")
+    previously_loaded = list(client.loaded())
+
+    kinds = {model: is_embedding(client, model) for model in models}
+    chat = [model for model in models if not kinds[model]]
+    embedding = [model for model in models if kinds[model]]
+    results: Dict[str, Dict] = {"chat": {}, "embedding": {}}
+    try:
+        for model in chat + embedding:
+            # Unload everything so each model loads cold and is measured alone
+            for name in client.loaded():
+                client.unload(name)
+            print(f"[INFO] Benchmarking {model}", file=sys.stderr)
+            try:
+                if kinds[model]:
+                    results["embedding"][model] = bench_embedding(client, model)
+                else:
+                    results["chat"][model] = bench_chat(client, model, args.tokens)
+            except requests.RequestException as e:
+                print(f"[WARN] {model} failed: {e}", file=sys.stderr)
+            client.unload(model)
+    finally:
+        # Put back whatever the stack had warmed up, with the server's keep_alive
+        for name in previously_loaded:
+            try:
+                if kinds[name] if name in kinds else is_embedding(client, name):
+                    client.post('/api/embed', {'model': name, 'input': 'load'})
+                else:
+                    client.post('/api/generate', {'model': name, 'prompt': ''})
+            except requests.RequestException:
+                pass
+
+    # The biggest chat model is usually the least quantised, so it is the default reference
+    reference = args.reference or max(results["chat"], key=lambda m: installed[m], default=None)
+    if reference and reference in results["chat"]:
+        expected = results["chat"][reference]["answers"]
+        for result in results["chat"].values():
+            scores = [agreement(a, b) for a, b in zip(result["answers"], expected)]
+            result["agreement"] = sum(scores) / len(scores) if scores else 0.0
+    return {"reference": reference, "tokens": args.tokens, **results}
+
+def ranked_chat(report: Dict, min_agreement: float) -> List[str]:
+    """Fastest generation first, but models that disagree too often go last."""
+    chat = report["chat"]
+    return sorted(chat, key=lambda m: (chat[m].get("agreement", 0.0) < min_agreement,
+                                       -chat[m]["generation_tokens_per_s"]))
+
+def print_report(report: Dict, min_agreement: float):
+    if report["chat"]:
+        print(f"Chat models (agreement against {report['reference']}, "
+              f"below {min_agreement:.0%} ranked last)\n")
+        print(f"  {'#':>2} {'model':<40} {'gen tok/s':>9} {'prompt tok/s':>12} "
+              f"{'load':>7} {'memory':>8} {'agreement':>9}")
+        for rank, model in enumerate(ranked_chat(report, min_agreement), 1):
+            r = report["chat"][model]
+            print(f"  {rank:>2} {model:<40} {r['generation_tokens_per_s']:9.1f} "
+                  f"{r['prompt_tokens_per_s']:12.1f} {r['load_s']:6.1f}s {r['memory_gb']:6.1f}GB "
+                  f"{r.get('agreement', 0.0):9.0%}")
+    if report["embedding"]:
+        print("\nEmbedding models (retrieval = queries that find their own passage)\n")
+        print(f"  {'#':>2} {'model':<40} {'texts/s':>9} {'tok/s':>9} {'load':>7} "
+              f"{'memory':>8} {'dims':>5} {'retrieval':>9}")
+        embedding = report["embedding"]
+        ordered = sorted(embedding, key=lambda m: (-embedding[m]["retrieval_accuracy"],
+                                                   -embedding[m]["texts_per_s"]))
+        for rank, model in enumerate(ordered, 1):
+            r = embedding[model]
+            print(f"  {rank:>2} {model:<40} {r['texts_per_s']:9.1f} {r['prompt_tokens_per_s']:9.1f} "
+                  f"{r['load_s']:6.1f}s {r['memory_gb']:6.1f}GB {r['dimensions']:>5} "
+                  f"{r['retrieval_accuracy']:9.0%}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the models installed in a local Ollama.')
+    parser.add_argument('--url', default='http://localhost:11434', help='Ollama API address (default: http://localhost:11434)')
+    parser.add_argument('--model', action='append', default=[], metavar='TAG',
+                      help='Benchmark only this model tag (repeatable, default: every installed model)')
+    parser.add_argument('--reference', help='Chat model whose answers count as correct (default: the largest one)')
+    parser.add_argument('--tokens', type=int, default=32, help='Maximum tokens generated per prompt (default: 32)')
+    parser.add_argument('--min-agreement', type=float, default=0.6,
+                      help='Rank chat models agreeing less than this with the reference last (default: 0.6)')
+    parser.add_argument('--timeout', type=float, default=600, help='Seconds to wait for each API call (default: 600)')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    try:
+        report = run_benchmark(args)
+    except requests.RequestException as e:
+        print(f"[ERROR] Could not reach Ollama at {args.url}: {e}", file=sys.stderr)
+        sys.exit(1)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report, args.min_agreement)
+
+if __name__ == "__main__":
+    main()
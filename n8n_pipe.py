@@ -7,11 +7,26 @@ version: 0.1.0
 This module defines a Pipe class that utilizes N8N for an Agent
 """
 
-from typing import Optional, Callable, Awaitable
+from typing import Optional, Callable, Awaitable, AsyncGenerator, Literal
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
 from pydantic import BaseModel, Field
+from urllib.parse import urlsplit
 import os
+import re
+import json
+import codecs
+import hashlib
+import itertools
+import weakref
 import time
-import requests
+import uuid
+import logging
+import asyncio
+import aiohttp
+import numpy as np
+
+log = logging.getLogger(__name__)
 
 def extract_event_info(event_emitter) -> tuple[Optional[str], Optional[str]]:
     if not event_emitter or not event_emitter.__closure__:
@@ -23,11 +38,670 @@ def extract_event_info(event_emitter) -> tuple[Optional[str], Optional[str]]:
             return chat_id, message_id
     return None, None
 
+async def iter_lines(response: aiohttp.ClientResponse) -> AsyncGenerator[bytes, None]:
+    # Split on newlines ourselves: aiohttp's readline rejects very long lines,
+    # which a large buffered JSON body can easily produce
+    pending = b""
+    async for data in response.content.iter_any():
+        pending += data
+        if b"\n" not in data:
+            continue
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+def extract_stream_text(item, response_field: str) -> str:
+    """Return the text carried by one decoded item of an n8n streaming response."""
+    if isinstance(item, str):
+        return item
+    if not isinstance(item, dict):
+        return ""
+    kind = item.get("type")
+    if kind == "error":
+        raise Exception(item.get("content") or "n8n reported a streaming error")
+    if kind == "item":
+        return item.get("content") or ""
+    if kind in ("begin", "end"):
+        return ""
+    if response_field in item:
+        return item[response_field] or ""
+    return item.get("content") or ""
+
+def message_text(content) -> Optional[str]:
+    """The text of a message, or None when it carries more than text (e.g. images)."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list) and all(
+        isinstance(part, dict) and part.get("type") == "text" for part in content
+    ):
+        return "\n".join(part.get("text") or "" for part in content)
+    return None
+
+def normalize_question(question: str) -> str:
+    """Fold case, whitespace and trailing punctuation so trivial variants match."""
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!. ").lower()
+
+# Greetings and thanks only: "yes", "ok" or "sure" usually answer the agent
+SMALL_TALK = re.compile(
+    r"(hi|hello|hey|yo|thanks|thank you|thx|ty|bye|goodbye|cheers|"
+    r"good (morning|afternoon|evening|night))"
+    r"( (so much|a lot|again|there|very much))?"
+)
+KNOWLEDGE_HINT = re.compile(
+    r"\b(what|how|why|when|where|who|which|explain|describe|list|compare|"
+    r"summari[sz]e|find|search|show|tell)\b"
+)
+
+def classify_turn(question: str, max_words: int) -> Optional[str]:
+    """Label a turn "chat" or "knowledge" from cheap cues, or None when unsure."""
+    text = normalize_question(question)
+    if SMALL_TALK.fullmatch(re.sub(r"[^\w ]", "", text)):
+        return "chat"
+    if "?" in question or KNOWLEDGE_HINT.search(text):
+        return "knowledge"
+    if len(text.split()) > max_words:
+        return "knowledge"
+    return None
+
+class ResponseCache:
+    """Bounded in-memory cache of workflow answers with TTL and LRU eviction."""
+
+    def __init__(self):
+        self.entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str, ttl: float) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] > ttl:
+            del self.entries[key]
+            self.evictions += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, value: str, max_entries: int):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > max(max_entries, 0):
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def purge(self, ttl: float):
+        """Drop expired entries, which get() would otherwise only drop on lookup."""
+        cutoff = time.monotonic() - ttl
+        expired = [key for key, (stored, _) in self.entries.items() if stored < cutoff]
+        for key in expired:
+            del self.entries[key]
+            self.evictions += 1
+
+    def stats(self, ttl: Optional[float] = None) -> dict:
+        """Cache counters; with ttl, expired entries are purged first."""
+        if ttl is not None:
+            self.purge(ttl)
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+SIMILARITY_BUCKETS = (0.5, 0.6, 0.7, 0.75, 0.8, 0.85, 0.9, 0.925, 0.95, 0.975, 0.99, 1)
+
+class SemanticCache:
+    """Answers indexed by question embedding, matched by cosine similarity.
+
+    Vectors are kept unit-length in one preallocated float32 matrix, so a
+    lookup is a single matrix-vector product. Expired slots are reused first,
+    then the least recently used one.
+    """
+
+    def __init__(self):
+        self.vectors: Optional[np.ndarray] = None
+        self.answers: list[Optional[str]] = []
+        self.scopes: list[Optional[str]] = []
+        self.stored_at = np.zeros(0)
+        self.used_at = np.zeros(0)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.similarity = Histogram(SIMILARITY_BUCKETS)
+
+    def allocate(self, dimensions: int, capacity: int):
+        self.vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        self.answers = [None] * capacity
+        self.scopes = [None] * capacity
+        self.stored_at = np.full(capacity, -np.inf)
+        self.used_at = np.full(capacity, -np.inf)
+
+    def live(self, ttl: float) -> np.ndarray:
+        return self.stored_at >= time.monotonic() - ttl
+
+    def get(
+        self, vector: np.ndarray, scope: str, ttl: float, threshold: float
+    ) -> Optional[str]:
+        if self.vectors is None or self.vectors.shape[1] != len(vector):
+            self.misses += 1
+            return None
+        similarities = self.vectors @ vector
+        valid = self.live(ttl) & np.array([item == scope for item in self.scopes])
+        if not valid.any():
+            self.misses += 1
+            return None
+        similarities[~valid] = -np.inf
+        slot = int(np.argmax(similarities))
+        best = float(similarities[slot])
+        self.similarity.observe(max(best, 0.0))
+        if best < threshold:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used_at[slot] = time.monotonic()
+        return self.answers[slot]
+
+    def put(
+        self, vector: np.ndarray, scope: str, answer: str, capacity: int, ttl: float
+    ):
+        if capacity <= 0:
+            return
+        if self.vectors is None or self.vectors.shape != (capacity, len(vector)):
+            self.allocate(len(vector), capacity)
+        live = self.live(ttl)
+        if not live.all():
+            slot = int(np.argmin(np.where(live, np.inf, self.stored_at)))
+        else:
+            slot = int(np.argmin(self.used_at))
+            self.evictions += 1
+        now = time.monotonic()
+        self.vectors[slot] = vector
+        self.answers[slot] = answer
+        self.scopes[slot] = scope
+        self.stored_at[slot] = now
+        self.used_at[slot] = now
+
+    def clear(self):
+        self.vectors = None
+
+    def stats(self, ttl: Optional[float] = None) -> dict:
+        """Cache counters; with ttl, only entries that can still be served count."""
+        lookups = self.hits + self.misses
+        if self.vectors is None:
+            entries = 0
+        elif ttl is None:
+            entries = int(np.isfinite(self.stored_at).sum())
+        else:
+            entries = int(self.live(ttl).sum())
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+def unit_vector(values: list[float]) -> Optional[np.ndarray]:
+    vector = np.asarray(values, dtype=np.float32)
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else None
+
+class AdmissionQueue:
+    """Bounded-concurrency gate that admits waiting users in round-robin order."""
+
+    def __init__(self):
+        self.active = 0
+        self.active_by_user: dict[str, int] = {}
+        # Users are rotated to the back after each admission, so iterating
+        # this mapping gives the round-robin service order
+        self.waiting: OrderedDict[str, deque[asyncio.Future]] = OrderedDict()
+        self.max_concurrency = 0
+        self.max_per_user = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self.waiting.values())
+
+    def position(self, user_id: str, future: asyncio.Future) -> int:
+        """Estimate how many waiting requests will be admitted before this one."""
+        queue = self.waiting.get(user_id)
+        if not queue or future not in queue:
+            return 0
+        index = queue.index(future)
+        users = list(self.waiting)
+        user_rank = users.index(user_id)
+        ahead = index
+        for rank, other in enumerate(users):
+            if other == user_id:
+                continue
+            # Users earlier in the rotation get one extra turn at our depth
+            turns = index + 1 if rank < user_rank else index
+            ahead += min(len(self.waiting[other]), turns)
+        return ahead
+
+    def can_admit(self, user_id: str) -> bool:
+        if self.max_concurrency > 0 and self.active >= self.max_concurrency:
+            return False
+        if self.max_per_user > 0:
+            return self.active_by_user.get(user_id, 0) < self.max_per_user
+        return True
+
+    def admit(self, user_id: str):
+        self.active += 1
+        self.active_by_user[user_id] = self.active_by_user.get(user_id, 0) + 1
+        self.admitted += 1
+
+    def dispatch(self):
+        """Hand free slots to waiting users in round-robin order."""
+        progress = True
+        while progress:
+            progress = False
+            for user_id in list(self.waiting):
+                queue = self.waiting[user_id]
+                while queue and queue[0].done():
+                    queue.popleft()
+                if not queue:
+                    del self.waiting[user_id]
+                    continue
+                if not self.can_admit(user_id):
+                    continue
+                self.admit(user_id)
+                queue.popleft().set_result(None)
+                self.waiting.move_to_end(user_id)
+                progress = True
+                break
+
+    def release(self, user_id: str):
+        self.active -= 1
+        remaining = self.active_by_user.get(user_id, 1) - 1
+        if remaining > 0:
+            self.active_by_user[user_id] = remaining
+        else:
+            self.active_by_user.pop(user_id, None)
+        self.dispatch()
+
+    async def acquire(
+        self,
+        user_id: str,
+        max_depth: int,
+        timeout: float,
+        on_wait: Callable[[int], Awaitable[None]],
+        poll_interval: float = 1.0,
+    ):
+        """Wait for a slot, rejecting at once when the queue is full."""
+        if not self.waiting and self.can_admit(user_id):
+            self.admit(user_id)
+            return
+        if max_depth > 0 and self.depth() >= max_depth:
+            self.rejected += 1
+            raise Exception(f"Server busy: {self.depth()} requests already queued")
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(user_id, deque()).append(future)
+        # Slots may be free for this user while others wait on their own limit
+        self.dispatch()
+        deadline = time.monotonic() + timeout
+        try:
+            while not future.done():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timed_out += 1
+                    raise Exception(f"Timed out after {timeout:g}s in the queue")
+                await on_wait(self.position(user_id, future))
+                await asyncio.wait({future}, timeout=min(remaining, poll_interval))
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # Admitted while giving up, so hand the slot to the next waiter
+                self.release(user_id)
+            else:
+                future.cancel()
+                self.dispatch()
+            raise
+
+class Endpoint:
+    """One n8n webhook URL with load and circuit breaker state."""
+
+    def __init__(self, url: str, weight: float = 1.0):
+        self.url = url
+        self.weight = weight
+        self.outstanding = 0
+        self.current_weight = 0.0
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.latency = None
+
+    def available(self, reset_timeout: float) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < reset_timeout:
+                return False
+            self.state = "half_open"
+            log.info("n8n endpoint %s half-open, probing", self.url)
+        if self.state == "half_open":
+            # Let a single probe through until it settles the breaker
+            return self.outstanding == 0
+        return True
+
+    def record_success(self, latency: float):
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.latency = (
+            latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        )
+        if self.state != "closed":
+            log.info("n8n endpoint %s recovered, circuit closed", self.url)
+            self.state = "closed"
+
+    def record_failure(self, threshold: int):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == "half_open" or (
+            self.state == "closed" and self.consecutive_failures >= threshold
+        ):
+            log.warning(
+                "n8n endpoint %s failed %d times in a row, circuit open",
+                self.url,
+                self.consecutive_failures,
+            )
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "weight": self.weight,
+            "state": self.state,
+            "outstanding": self.outstanding,
+            "successes": self.successes,
+            "failures": self.failures,
+            "latency": self.latency,
+        }
+
+class EndpointPool:
+    """Balances calls across the configured n8n webhook endpoints."""
+
+    def __init__(self):
+        self.endpoints: list[Endpoint] = []
+        self.spec = None
+
+    def configure(self, spec: str):
+        """Parse "url|weight, url|weight" keeping the state of known URLs."""
+        if spec == self.spec:
+            return
+        known = {endpoint.url: endpoint for endpoint in self.endpoints}
+        endpoints = []
+        for item in spec.split(","):
+            url, _, weight = item.strip().partition("|")
+            if not url:
+                continue
+            endpoint = known.get(url) or Endpoint(url)
+            endpoint.weight = max(float(weight or 1), 0.001)
+            endpoints.append(endpoint)
+        self.endpoints = endpoints
+        self.spec = spec
+
+    def select(
+        self, strategy: str, reset_timeout: float, exclude: list[Endpoint] = ()
+    ) -> Optional[Endpoint]:
+        candidates = [
+            endpoint
+            for endpoint in self.endpoints
+            if endpoint not in exclude and endpoint.available(reset_timeout)
+        ]
+        if not candidates:
+            return None
+        if strategy == "weighted":
+            # Smooth weighted round-robin, as used by nginx
+            total = sum(endpoint.weight for endpoint in candidates)
+            for endpoint in candidates:
+                endpoint.current_weight += endpoint.weight
+            chosen = max(candidates, key=lambda endpoint: endpoint.current_weight)
+            chosen.current_weight -= total
+            return chosen
+        return min(
+            candidates,
+            key=lambda endpoint: (
+                endpoint.outstanding / endpoint.weight,
+                endpoint.latency or 0.0,
+            ),
+        )
+
+class Histogram:
+    """Cumulative Prometheus-style histogram with fixed upper bounds."""
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+    def render(self, metric: str, labels: str = "") -> list[str]:
+        prefix = f"{labels}," if labels else ""
+        lines = [
+            f'{metric}_bucket{{{prefix}le="{bound:g}"}} {count}'
+            for bound, count in zip(self.buckets, self.counts)
+        ]
+        lines.append(f'{metric}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{metric}_sum{suffix} {self.sum:g}")
+        lines.append(f"{metric}_count{suffix} {self.count}")
+        return lines
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+class PipeMetrics:
+    """In-memory per-phase request histograms, rendered in Prometheus text format."""
+
+    HISTOGRAMS = {
+        "queue_wait": (
+            "n8n_pipe_queue_wait_seconds",
+            "Time spent waiting for admission",
+            LATENCY_BUCKETS,
+        ),
+        "connect": (
+            "n8n_pipe_connect_seconds",
+            "Time spent opening a connection to n8n",
+            LATENCY_BUCKETS,
+        ),
+        "ttfb": (
+            "n8n_pipe_time_to_first_byte_seconds",
+            "Time until n8n sent response headers",
+            LATENCY_BUCKETS,
+        ),
+        "total": (
+            "n8n_pipe_request_seconds",
+            "Total time to answer a request",
+            LATENCY_BUCKETS,
+        ),
+        "size": (
+            "n8n_pipe_response_bytes",
+            "Size of the n8n response body",
+            SIZE_BUCKETS,
+        ),
+    }
+
+    def __init__(self):
+        self.histograms: dict[tuple[str, str, str], Histogram] = {}
+
+    def observe(self, name: str, workflow: str, outcome: str, value: float):
+        key = (name, workflow, outcome)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.HISTOGRAMS[name][2])
+        histogram.observe(value)
+
+    def record(self, timings: dict, workflow: str, outcome: str):
+        for name in self.HISTOGRAMS:
+            if name in timings:
+                self.observe(name, workflow, outcome, timings[name])
+
+    def render(
+        self,
+        counters: Optional[dict[str, tuple[str, float]]] = None,
+        histograms: Optional[dict[str, tuple[str, Histogram]]] = None,
+        series: Optional[dict[str, tuple[str, list[tuple[str, float]]]]] = None,
+    ) -> str:
+        lines = []
+        for name, (metric, help_text, _) in self.HISTOGRAMS.items():
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for (key, workflow, outcome), histogram in sorted(self.histograms.items()):
+                if key != name:
+                    continue
+                labels = f'workflow="{escape_label(workflow)}",outcome="{outcome}"'
+                lines.extend(histogram.render(metric, labels))
+        for metric, (help_text, histogram) in (histograms or {}).items():
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            lines.extend(histogram.render(metric))
+        for metric, (help_text, value) in (counters or {}).items():
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(
+                f"# TYPE {metric} {'gauge' if metric.endswith('_current') else 'counter'}"
+            )
+            lines.append(f"{metric} {value:g}")
+        for metric, (help_text, samples) in (series or {}).items():
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(
+                f"# TYPE {metric} {'gauge' if metric.endswith('_current') else 'counter'}"
+            )
+            for labels, value in samples:
+                lines.append(f"{metric}{{{labels}}} {value:g}")
+        return "\n".join(lines) + "\n"
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def request_outcome(error: BaseException) -> str:
+    return "timeout" if isinstance(error, asyncio.TimeoutError) else "error"
+
+async def on_request_start(session, context, params):
+    if context.trace_request_ctx is not None:
+        context.trace_request_ctx["request_start"] = time.monotonic()
+
+async def on_connection_create_start(session, context, params):
+    if context.trace_request_ctx is not None:
+        context.trace_request_ctx["connect_start"] = time.monotonic()
+
+async def on_connection_create_end(session, context, params):
+    timings = context.trace_request_ctx
+    if timings is not None and "connect_start" in timings:
+        timings["connect"] = time.monotonic() - timings["connect_start"]
+
+async def on_connection_reuseconn(session, context, params):
+    if context.trace_request_ctx is not None:
+        context.trace_request_ctx["connect"] = 0.0
+
+async def on_request_end(session, context, params):
+    timings = context.trace_request_ctx
+    if timings is not None and "request_start" in timings:
+        timings["ttfb"] = time.monotonic() - timings["request_start"]
+
+async def on_response_chunk_received(session, context, params):
+    if context.trace_request_ctx is not None:
+        context.trace_request_ctx["size"] = context.trace_request_ctx.get(
+            "size", 0
+        ) + len(params.chunk)
+
+def timing_trace_config() -> aiohttp.TraceConfig:
+    """Trace hooks that fill the dict passed as trace_request_ctx with timings."""
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_response_chunk_received.append(on_response_chunk_received)
+    return trace_config
+
 class Pipe:
     class Valves(BaseModel):
         n8n_url: str = Field(
             default="https://n8n.[your domain].com/webhook/[your webhook URL]"
         )
+        n8n_internal_url: str = Field(
+            default="",
+            description="Same webhook on the Docker network, e.g. http://n8n:5678/webhook/..., "
+            "used instead of n8n_url while n8n answers there (empty to disable)",
+        )
+        internal_probe_interval: float = Field(
+            default=300.0,
+            description="Seconds between checks that n8n_internal_url is reachable",
+        )
+        n8n_urls: str = Field(
+            default="",
+            description="Comma-separated webhook URLs to balance across, each "
+            "optionally suffixed with |weight; n8n_url is used when empty",
+        )
+        balance_strategy: Literal["least_outstanding", "weighted"] = Field(
+            default="least_outstanding",
+            description="How to pick an endpoint from n8n_urls",
+        )
+        breaker_failure_threshold: int = Field(
+            default=5,
+            description="Consecutive failures before an endpoint's circuit opens",
+        )
+        breaker_reset_timeout: float = Field(
+            default=30.0,
+            description="Seconds an open circuit waits before a half-open probe",
+        )
+        hedge_enabled: bool = Field(
+            default=False,
+            description="Retry or hedge on a second endpoint; only for idempotent workflows",
+        )
+        hedge_delay: float = Field(
+            default=5.0,
+            description="Seconds to wait for the first endpoint before hedging",
+        )
+        metrics_port: int = Field(
+            default=0,
+            description="Serve Prometheus metrics on this port (0 to disable)",
+        )
+        metrics_host: str = Field(
+            default="127.0.0.1", description="Address the metrics listener binds to"
+        )
+        job_mode: bool = Field(
+            default=False,
+            description="Submit the question as a job and poll job_result_url for the answer",
+        )
+        job_result_url: str = Field(
+            default="https://n8n.[your domain].com/webhook/job-result",
+            description="Webhook that returns the status and output of a job",
+        )
+        job_poll_interval: float = Field(
+            default=1.0, description="Initial seconds between job result polls"
+        )
+        job_poll_max_interval: float = Field(
+            default=10.0, description="Upper bound for the job poll backoff"
+        )
+        job_wait: float = Field(
+            default=25.0,
+            description="Seconds the result webhook may hold a poll open (long-poll)",
+        )
+        job_timeout: float = Field(
+            default=1800.0, description="Seconds to wait for a job to finish"
+        )
         n8n_bearer_token: str = Field(default="...")
         input_field: str = Field(default="chatInput")
         response_field: str = Field(default="output")
@@ -37,6 +711,120 @@ class Pipe:
         enable_status_indicator: bool = Field(
             default=True, description="Enable or disable status indicator emissions"
         )
+        pool_size: int = Field(
+            default=100,
+            description="Maximum number of pooled keep-alive connections to n8n",
+        )
+        request_deadline: float = Field(
+            default=0.0,
+            description="End-to-end seconds allowed per request, queueing included, "
+            "sent to n8n as X-Request-Deadline (0 for no deadline)",
+        )
+        connect_timeout: float = Field(
+            default=10.0, description="Seconds to wait for a connection to n8n"
+        )
+        read_timeout: float = Field(
+            default=300.0,
+            description="Seconds to wait for data from n8n before giving up",
+        )
+        stream: bool = Field(
+            default=False,
+            description="Relay chunks from a streaming n8n webhook as they arrive",
+        )
+        cache_enabled: bool = Field(
+            default=False, description="Answer repeated questions from a local cache"
+        )
+        cache_scope: Literal["global", "session"] = Field(
+            default="global",
+            description="Share cached answers across chats or keep them per sessionId",
+        )
+        cache_ttl: float = Field(
+            default=3600.0, description="Seconds a cached answer stays valid"
+        )
+        cache_max_entries: int = Field(
+            default=1000, description="Maximum number of cached answers"
+        )
+        cache_bypass_prefix: str = Field(
+            default="/nocache",
+            description="Messages starting with this skip the cache lookup and refresh "
+            "the cached answer; the prefix is not sent to n8n (empty to disable)",
+        )
+        semantic_cache_enabled: bool = Field(
+            default=False,
+            description="Also answer paraphrased questions from the cache using embeddings",
+        )
+        semantic_cache_threshold: float = Field(
+            default=0.92,
+            description="Minimum cosine similarity for a semantic cache hit",
+        )
+        semantic_cache_max_entries: int = Field(
+            default=1000, description="Maximum number of semantically cached answers"
+        )
+        ollama_url: str = Field(
+            default="http://ollama:11434",
+            description="Ollama server used for embeddings",
+        )
+        embedding_model: str = Field(
+            default="nomic-embed-text", description="Ollama model that embeds questions"
+        )
+        embedding_timeout: float = Field(
+            default=5.0, description="Seconds to wait for a question embedding"
+        )
+        router_enabled: bool = Field(
+            default=False,
+            description="Answer small talk on a fast path instead of the agent workflow",
+        )
+        router_max_words: int = Field(
+            default=6,
+            description="Longer turns always go to the workflow unless clearly small talk",
+        )
+        router_model: str = Field(
+            default="",
+            description="Small Ollama model that classifies turns the heuristics can't "
+            "(empty to send them to the workflow)",
+        )
+        fast_path_model: str = Field(
+            default="qwen2.5:7b-instruct-q4_K_M",
+            description="Ollama model that answers fast-path turns directly",
+        )
+        fast_path_url: str = Field(
+            default="",
+            description="Cheaper n8n webhook for fast-path turns (empty to call Ollama directly)",
+        )
+        fast_path_timeout: float = Field(
+            default=30.0, description="Seconds to wait for a fast-path answer"
+        )
+        cancel_url: str = Field(
+            default="",
+            description="Webhook told the requestId, sessionId and jobId of abandoned "
+            "calls so the workflow can stop its execution (empty to disable)",
+        )
+        coalesce_enabled: bool = Field(
+            default=True,
+            description="Share one n8n call between identical concurrent requests",
+        )
+        coalesce_scope: Literal["payload", "question"] = Field(
+            default="payload",
+            description="Coalesce identical payloads only, which include the sessionId, "
+            "or the same question across users and chats; question shares one answer "
+            "between them and so ignores each chat's agent memory",
+        )
+        max_concurrency: int = Field(
+            default=0,
+            description="Maximum concurrent n8n calls, queueing the rest (0 for no limit)",
+        )
+        max_concurrency_per_user: int = Field(
+            default=0,
+            description="Maximum concurrent n8n calls per user, so one user's chats "
+            "queue behind each other (0 for no limit)",
+        )
+        max_queue_depth: int = Field(
+            default=100,
+            description="Reject new requests when this many are already queued",
+        )
+        queue_timeout: float = Field(
+            default=120.0, description="Seconds a request may wait in the queue"
+        )
 
     def __init__(self):
         self.type = "pipe"
@@ -44,7 +832,233 @@ class Pipe:
         self.name = "N8N Pipe"
         self.valves = self.Valves()
         self.last_emit_time = 0
-        pass
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.session_pool_size = 0
+        self.retired_sessions: list[aiohttp.ClientSession] = []
+        self.cache = ResponseCache()
+        self.semantic_cache = SemanticCache()
+        self.inflight: dict[str, asyncio.Task] = {}
+        self.coalesced_calls = 0
+        self.admission = AdmissionQueue()
+        self.endpoints = EndpointPool()
+        self.metrics = PipeMetrics()
+        self.metrics_runner = None
+        self.metrics_port = 0
+        self.heartbeats: dict[int, list] = {}
+        self.heartbeat_ids = itertools.count()
+        self.heartbeat_task: Optional[asyncio.Task] = None
+        self.jobs: dict[str, str] = {}
+        self.internal_ok: Optional[bool] = None
+        self.internal_checked = 0.0
+        self.internal_probe: Optional[asyncio.Task] = None
+        self.fast_path_calls = 0
+        self.cancelled_calls = 0
+        self.waiters: dict[asyncio.Task, int] = {}
+        self.background: set[asyncio.Task] = set()
+        self.fast_path_saved = 0.0
+        self.workflow_latency: Optional[float] = None
+        self.last_emit_times = weakref.WeakKeyDictionary()
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """Return the shared client session, creating it on first use."""
+        # Valves are replaced by Open WebUI between calls, so rebuild the pool
+        # when its size changes
+        if (
+            self.session is not None
+            and not self.session.closed
+            and self.session_pool_size != self.valves.pool_size
+        ):
+            # Streams may still be reading from the old pool; its idle connections
+            # expire on their own and the session itself is closed on shutdown
+            self.retired_sessions.append(self.session)
+            self.session = None
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.valves.pool_size, keepalive_timeout=60
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector, trace_configs=[timing_trace_config()]
+            )
+            self.session_pool_size = self.valves.pool_size
+        return self.session
+
+    async def close(self):
+        """Close the shared client session and its pooled connections."""
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+        for session in [self.session, *self.retired_sessions]:
+            if session is not None and not session.closed:
+                await session.close()
+        self.session = None
+        self.retired_sessions = []
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+            self.metrics_runner = None
+        self.metrics_port = 0
+
+    def metrics_text(self) -> str:
+        """Dump request timings and counters in Prometheus text format."""
+        cache = self.cache.stats(self.valves.cache_ttl)
+        semantic = self.semantic_cache.stats(self.valves.cache_ttl)
+        counters = {
+            "n8n_pipe_cache_hits_total": (
+                "Answers served from the response cache",
+                cache["hits"],
+            ),
+            "n8n_pipe_cache_misses_total": (
+                "Response cache lookups that missed",
+                cache["misses"],
+            ),
+            "n8n_pipe_cache_entries_current": (
+                "Unexpired answers in the response cache",
+                cache["entries"],
+            ),
+            "n8n_pipe_semantic_cache_entries_current": (
+                "Unexpired answers in the semantic cache",
+                semantic["entries"],
+            ),
+            "n8n_pipe_semantic_cache_hits_total": (
+                "Answers served from the semantic cache",
+                semantic["hits"],
+            ),
+            "n8n_pipe_semantic_cache_misses_total": (
+                "Semantic cache lookups below the similarity threshold",
+                semantic["misses"],
+            ),
+            "n8n_pipe_coalesced_calls_total": (
+                "Upstream calls saved by coalescing",
+                self.coalesced_calls,
+            ),
+            "n8n_pipe_admission_rejected_total": (
+                "Requests rejected because the queue was full",
+                self.admission.rejected,
+            ),
+            "n8n_pipe_admission_timeouts_total": (
+                "Requests that timed out in the queue",
+                self.admission.timed_out,
+            ),
+            "n8n_pipe_active_requests_current": (
+                "Upstream calls currently admitted",
+                self.admission.active,
+            ),
+            "n8n_pipe_queued_requests_current": (
+                "Requests waiting for admission",
+                self.admission.depth(),
+            ),
+            "n8n_pipe_internal_path_current": (
+                "1 while calls go to n8n_internal_url instead of n8n_url",
+                int(bool(self.internal_ok and self.valves.n8n_internal_url)),
+            ),
+            "n8n_pipe_cancelled_calls_total": (
+                "Upstream calls aborted because every requester went away",
+                self.cancelled_calls,
+            ),
+            "n8n_pipe_fast_path_requests_total": (
+                "Turns answered on the fast path instead of the workflow",
+                self.fast_path_calls,
+            ),
+            "n8n_pipe_fast_path_saved_seconds_total": (
+                "Estimated workflow seconds saved by the fast path",
+                self.fast_path_saved,
+            ),
+        }
+        histograms = {
+            "n8n_pipe_semantic_cache_similarity": (
+                "Best cosine similarity found per semantic cache lookup",
+                self.semantic_cache.similarity,
+            )
+        }
+        return self.metrics.render(counters, histograms, self.endpoint_series())
+
+    def endpoint_series(self) -> dict[str, tuple[str, list[tuple[str, float]]]]:
+        """Per-endpoint health, breaker state and latency as labelled samples."""
+        up, states, outstanding, latency, successes, failures = [], [], [], [], [], []
+        for endpoint in self.endpoint_stats():
+            label = f'endpoint="{escape_label(endpoint["url"])}"'
+            up.append((label, int(endpoint["state"] != "open")))
+            for state in ("closed", "half_open", "open"):
+                states.append(
+                    (f'{label},state="{state}"', int(endpoint["state"] == state))
+                )
+            outstanding.append((label, endpoint["outstanding"]))
+            if endpoint["latency"] is not None:
+                latency.append((label, endpoint["latency"]))
+            successes.append((label, endpoint["successes"]))
+            failures.append((label, endpoint["failures"]))
+        return {
+            "n8n_pipe_endpoint_up_current": (
+                "1 while the endpoint's circuit breaker lets calls through",
+                up,
+            ),
+            "n8n_pipe_endpoint_breaker_state_current": (
+                "1 for the circuit breaker state the endpoint is in",
+                states,
+            ),
+            "n8n_pipe_endpoint_outstanding_current": (
+                "Calls in flight to the endpoint",
+                outstanding,
+            ),
+            "n8n_pipe_endpoint_latency_seconds_current": (
+                "Moving average latency of the endpoint's successful calls",
+                latency,
+            ),
+            "n8n_pipe_endpoint_successes_total": (
+                "Successful calls to the endpoint",
+                successes,
+            ),
+            "n8n_pipe_endpoint_failures_total": (
+                "Failed calls to the endpoint",
+                failures,
+            ),
+        }
+
+    async def start_metrics_listener(self):
+        """Start the opt-in Prometheus listener once metrics_port is set."""
+        port = self.valves.metrics_port
+        if port <= 0 or port == self.metrics_port:
+            return
+        # Claim the port before awaiting so concurrent requests start one listener
+        self.metrics_port = port
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+            self.metrics_runner = None
+        from aiohttp import web
+
+        async def handle(request):
+            return web.Response(
+                text=self.metrics_text(), content_type="text/plain", charset="utf-8"
+            )
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.valves.metrics_host, port).start()
+        except OSError as e:
+            await runner.cleanup()
+            log.warning("Could not start n8n pipe metrics listener: %s", e)
+            return
+        self.metrics_runner = runner
+
+    def record_request(self, timings: dict, started: float, outcome: str):
+        timings["total"] = time.monotonic() - started
+        workflow = (
+            timings.get("workflow") or self.valves.n8n_urls or self.valves.n8n_url
+        )
+        self.metrics.record(timings, workflow, outcome)
+        if outcome == "ok" and "fast_path" not in timings:
+            # Smoothed workflow latency, the baseline for fast-path savings
+            if self.workflow_latency is None:
+                self.workflow_latency = timings["total"]
+            else:
+                self.workflow_latency += 0.2 * (
+                    timings["total"] - self.workflow_latency
+                )
+
+    async def on_shutdown(self):
+        await self.close()
 
     async def emit_status(
         self,
@@ -52,13 +1066,21 @@ class Pipe:
         level: str,
         message: str,
         done: bool,
+        force: bool = False,
     ):
         current_time = time.time()
+        # Throttle per emitter so concurrent chats do not suppress each other
+        try:
+            last_emit_time = self.last_emit_times.get(__event_emitter__, 0)
+        except TypeError:
+            last_emit_time = self.last_emit_time
         if (
             __event_emitter__
             and self.valves.enable_status_indicator
             and (
-                current_time - self.last_emit_time >= self.valves.emit_interval or done
+                current_time - last_emit_time >= self.valves.emit_interval
+                or done
+                or force
             )
         ):
             await __event_emitter__(
@@ -73,6 +1095,890 @@ class Pipe:
                 }
             )
             self.last_emit_time = current_time
+            try:
+                self.last_emit_times[__event_emitter__] = current_time
+            except TypeError:
+                pass
+
+    @contextmanager
+    def heartbeat(self, __event_emitter__: Callable[[dict], Awaitable[None]]):
+        """Report elapsed time while the block runs; yields a key to stop early."""
+        if not __event_emitter__ or not self.valves.enable_status_indicator:
+            yield None
+            return
+        key = next(self.heartbeat_ids)
+        self.heartbeats[key] = [
+            __event_emitter__,
+            time.monotonic(),
+            "Running N8N workflow",
+        ]
+        # One shared ticker serves every in-flight request, so hundreds of
+        # concurrent chats cost a single timer rather than one task each
+        if self.heartbeat_task is None:
+            self.heartbeat_task = asyncio.ensure_future(self.run_heartbeats())
+        try:
+            yield key
+        finally:
+            self.heartbeats.pop(key, None)
+
+    async def run_heartbeats(self):
+        try:
+            while self.heartbeats:
+                await asyncio.sleep(self.valves.emit_interval)
+                now = time.monotonic()
+                await asyncio.gather(
+                    *(
+                        self.emit_status(
+                            emitter,
+                            "info",
+                            f"{label}... {now - started:.0f}s elapsed",
+                            False,
+                            force=True,
+                        )
+                        for emitter, started, label in list(self.heartbeats.values())
+                    ),
+                    return_exceptions=True,
+                )
+        finally:
+            if self.heartbeat_task is asyncio.current_task():
+                self.heartbeat_task = None
+
+    def cache_scope(self, session_id: str) -> str:
+        session = session_id if self.valves.cache_scope == "session" else ""
+        return json.dumps([self.valves.n8n_url, session])
+
+    def cache_key(self, question: str, session_id: str) -> str:
+        key = json.dumps([self.cache_scope(session_id), normalize_question(question)])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    async def embed(self, text: str) -> Optional[np.ndarray]:
+        """Embed text with Ollama, or return None so the caller skips the cache."""
+        try:
+            async with self.get_session().post(
+                f"{self.valves.ollama_url.rstrip('/')}/api/embed",
+                json={"model": self.valves.embedding_model, "input": text},
+                timeout=aiohttp.ClientTimeout(total=self.valves.embedding_timeout),
+            ) as response:
+                if response.status != 200:
+                    error = await response.text()
+                    raise Exception(f"Error: {response.status} - {error}")
+                data = await response.json(content_type=None)
+            # /api/embed returns a batch; older Ollama builds only had "embedding"
+            if "embeddings" in data:
+                return unit_vector(data["embeddings"][0])
+            return unit_vector(data["embedding"])
+        except Exception as e:
+            log.warning("Embedding the question for the semantic cache failed: %r", e)
+            return None
+
+    async def lookup_cached(
+        self, question: str, session_id: str, refresh: bool = False
+    ) -> tuple[Optional[str], Optional[Callable[[str], None]]]:
+        """Return a cached answer, or a callback that caches a fresh one.
+
+        With refresh the lookup is skipped, so the fresh answer replaces the cached one.
+        """
+        cache_key = None
+        vector = None
+        scope = self.cache_scope(session_id)
+        if self.valves.cache_enabled:
+            cache_key = self.cache_key(question, session_id)
+            answer = (
+                None if refresh else self.cache.get(cache_key, self.valves.cache_ttl)
+            )
+            if answer is not None:
+                return answer, None
+        if self.valves.semantic_cache_enabled:
+            vector = await self.embed(normalize_question(question))
+            if vector is not None and not refresh:
+                answer = self.semantic_cache.get(
+                    vector,
+                    scope,
+                    self.valves.cache_ttl,
+                    self.valves.semantic_cache_threshold,
+                )
+                if answer is not None:
+                    if cache_key is not None:
+                        self.cache.put(cache_key, answer, self.valves.cache_max_entries)
+                    return answer, None
+
+        def remember(answer: str):
+            if cache_key is not None:
+                self.cache.put(cache_key, answer, self.valves.cache_max_entries)
+            if vector is not None:
+                self.semantic_cache.put(
+                    vector,
+                    scope,
+                    answer,
+                    self.valves.semantic_cache_max_entries,
+                    self.valves.cache_ttl,
+                )
+
+        return None, remember
+
+    async def route(
+        self,
+        question: str,
+        history: list,
+        headers: dict,
+        __user__: Optional[dict] = None,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+    ) -> str:
+        """Decide whether a turn needs the agent workflow or the fast path."""
+        previous = next(
+            (m for m in reversed(history) if m.get("role") == "assistant"), None
+        )
+        if previous is not None:
+            asked = message_text(previous.get("content")) or ""
+            if asked.rstrip().endswith("?"):
+                # A reply to the agent's own question belongs to its session
+                log.info("Routed turn to the workflow (reply to its question)")
+                return "workflow"
+        label = classify_turn(question, self.valves.router_max_words)
+        reason = "heuristic"
+        if label is None and self.valves.router_model:
+            label = await self.classify_with_model(
+                question, headers, __user__, __event_emitter__
+            )
+            reason = "model"
+        if label is None:
+            label, reason = "knowledge", "default"
+        route = "fast" if label == "chat" else "workflow"
+        log.info("Routed turn to the %s (%s: %s)", route, reason, label)
+        return route
+
+    async def classify_with_model(
+        self,
+        question: str,
+        headers: dict,
+        __user__: Optional[dict] = None,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+    ) -> Optional[str]:
+        prompt = (
+            "Reply with one word. Answer CHAT if the message below is small talk, "
+            "a greeting, thanks or a reaction that needs no facts or documents. "
+            "Answer KNOWLEDGE otherwise.\n\nMessage: " + question
+        )
+        try:
+            async with self.admitted(
+                __user__, __event_emitter__, headers=headers
+            ), self.get_session().post(
+                f"{self.valves.ollama_url.rstrip('/')}/api/generate",
+                json={
+                    "model": self.valves.router_model,
+                    "prompt": prompt,
+                    "stream": False,
+                    "options": {"temperature": 0, "num_predict": 3},
+                },
+                timeout=self.fast_path_timeout(headers),
+            ) as response:
+                if response.status != 200:
+                    error = await response.text()
+                    raise Exception(f"Error: {response.status} - {error}")
+                data = await response.json(content_type=None)
+        except Exception as e:
+            log.warning(
+                "Classifying the turn with %s failed: %r", self.valves.router_model, e
+            )
+            return None
+        answer = data.get("response", "").strip().upper()
+        if answer.startswith("CHAT"):
+            return "chat"
+        if answer.startswith("KNOWLEDGE"):
+            return "knowledge"
+        return None
+
+    async def call_fast_path(
+        self, body: dict, payload: dict, headers: dict, timings: dict
+    ) -> str:
+        """Answer a turn without the agent workflow."""
+        timeout = self.fast_path_timeout(headers)
+        session = self.get_session()
+        if self.valves.fast_path_url:
+            timings["workflow"] = self.valves.fast_path_url
+            async with session.post(
+                self.valves.fast_path_url,
+                json=payload,
+                headers=headers,
+                timeout=timeout,
+            ) as response:
+                if response.status != 200:
+                    text = await response.text()
+                    raise Exception(f"Error: {response.status} - {text}")
+                data = await response.json(content_type=None)
+            return data[self.valves.response_field]
+        url = f"{self.valves.ollama_url.rstrip('/')}/api/chat"
+        timings["workflow"] = f"{url}#{self.valves.fast_path_model}"
+        messages = [
+            {"role": message["role"], "content": message["content"]}
+            for message in body["messages"]
+            if isinstance(message.get("content"), str)
+        ]
+        async with session.post(
+            url,
+            json={
+                "model": self.valves.fast_path_model,
+                "messages": messages,
+                "stream": False,
+            },
+            timeout=timeout,
+        ) as response:
+            if response.status != 200:
+                text = await response.text()
+                raise Exception(f"Error: {response.status} - {text}")
+            data = await response.json(content_type=None)
+        return data["message"]["content"]
+
+    async def answer_fast(
+        self,
+        body: dict,
+        payload: dict,
+        headers: dict,
+        __user__: Optional[dict] = None,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+    ) -> Optional[str]:
+        """Run the fast path, or return None so the turn falls back to the workflow."""
+        timings = {"fast_path": True}
+        started = time.monotonic()
+        try:
+            async with self.admitted(__user__, __event_emitter__, timings, headers):
+                answer = await self.call_fast_path(body, payload, headers, timings)
+        except Exception as e:
+            self.record_request(timings, started, request_outcome(e))
+            log.warning("Fast path failed, using the workflow instead: %r", e)
+            return None
+        self.record_request(timings, started, "ok")
+        elapsed = timings["total"]
+        saved = max((self.workflow_latency or elapsed) - elapsed, 0.0)
+        self.fast_path_calls += 1
+        self.fast_path_saved += saved
+        log.info(
+            "Fast path answered in %.2fs, about %.2fs sooner than the workflow",
+            elapsed,
+            saved,
+        )
+        return answer
+
+    @asynccontextmanager
+    async def admitted(
+        self,
+        __user__: Optional[dict] = None,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+        timings: Optional[dict] = None,
+        headers: Optional[dict] = None,
+    ):
+        """Hold an admission slot for the duration of one upstream call."""
+        user_id = str((__user__ or {}).get("id") or "anonymous")
+        queue = self.admission
+        queue.max_concurrency = self.valves.max_concurrency
+        queue.max_per_user = self.valves.max_concurrency_per_user
+        reported = None
+        started = time.monotonic()
+
+        async def on_wait(ahead: int):
+            nonlocal reported
+            if ahead != reported:
+                await self.emit_status(
+                    __event_emitter__,
+                    "info",
+                    f"Queued, {ahead} ahead",
+                    False,
+                    force=reported is None,
+                )
+                reported = ahead
+
+        timeout = self.valves.queue_timeout
+        budget = self.remaining(headers)
+        if budget is not None:
+            timeout = min(timeout, budget)
+        try:
+            await queue.acquire(
+                user_id,
+                self.valves.max_queue_depth,
+                timeout,
+                on_wait,
+                poll_interval=self.valves.emit_interval,
+            )
+        except Exception:
+            if self.deadline_passed(headers):
+                raise self.deadline_error("while queued")
+            raise
+        if timings is not None:
+            timings["queue_wait"] = time.monotonic() - started
+        try:
+            yield
+        finally:
+            queue.release(user_id)
+
+    def remaining(self, headers: Optional[dict]) -> Optional[float]:
+        """Seconds left before the request deadline, or None without one."""
+        deadline = (headers or {}).get("X-Request-Deadline")
+        if deadline is None:
+            return None
+        return float(deadline) - time.time()
+
+    def deadline_passed(self, headers: Optional[dict]) -> bool:
+        remaining = self.remaining(headers)
+        return remaining is not None and remaining <= 0
+
+    def deadline_error(self, phase: str) -> asyncio.TimeoutError:
+        return asyncio.TimeoutError(
+            f"Request deadline of {self.valves.request_deadline:g}s exceeded {phase}"
+        )
+
+    def fast_path_timeout(self, headers: dict) -> aiohttp.ClientTimeout:
+        """fast_path_timeout, cut short by the request deadline."""
+        timeout = self.valves.fast_path_timeout
+        remaining = self.remaining(headers)
+        if remaining is not None:
+            if remaining <= 0:
+                raise self.deadline_error("before the fast path")
+            timeout = min(timeout, remaining)
+        return aiohttp.ClientTimeout(total=timeout)
+
+    def request_timeout(self, headers: Optional[dict] = None) -> aiohttp.ClientTimeout:
+        remaining = self.remaining(headers)
+        if remaining is None:
+            return aiohttp.ClientTimeout(
+                sock_connect=self.valves.connect_timeout,
+                sock_read=self.valves.read_timeout,
+            )
+        # Fail fast rather than open a connection with no time left to use it
+        if remaining <= 0:
+            raise self.deadline_error("before calling n8n")
+        return aiohttp.ClientTimeout(
+            total=remaining,
+            sock_connect=min(self.valves.connect_timeout, remaining),
+            sock_read=self.valves.read_timeout,
+        )
+
+    async def within_deadline(self, call: Awaitable[str], headers: dict) -> str:
+        """Await a call, giving up when the request deadline passes."""
+        remaining = self.remaining(headers)
+        if remaining is None:
+            return await call
+        try:
+            return await asyncio.wait_for(call, max(remaining, 0))
+        except asyncio.TimeoutError as e:
+            if self.deadline_passed(headers) and not str(e):
+                raise self.deadline_error("before n8n answered") from None
+            raise
+
+    def webhook_url(self) -> str:
+        """The internal webhook URL while it is reachable, else the public one."""
+        if self.valves.n8n_internal_url and self.internal_ok:
+            return self.valves.n8n_internal_url
+        return self.valves.n8n_url
+
+    async def check_internal(self):
+        """Probe n8n_internal_url on first use, then again in the background."""
+        if not self.valves.n8n_internal_url:
+            return
+        due = (
+            time.monotonic() - self.internal_checked
+            >= self.valves.internal_probe_interval
+        )
+        if self.internal_probe is None and (self.internal_ok is None or due):
+            self.internal_probe = asyncio.ensure_future(self.probe_internal())
+        # Only the first request waits; later ones use the cached result
+        if self.internal_ok is None:
+            await asyncio.shield(self.internal_probe)
+
+    async def probe_internal(self):
+        url = urlsplit(self.valves.n8n_internal_url)
+        try:
+            async with self.get_session().get(
+                f"{url.scheme}://{url.netloc}/healthz",
+                timeout=aiohttp.ClientTimeout(total=self.valves.connect_timeout),
+            ) as response:
+                reachable = response.status == 200
+        except Exception as e:
+            log.debug("Probing %s failed: %r", self.valves.n8n_internal_url, e)
+            reachable = False
+        finally:
+            self.internal_checked = time.monotonic()
+            self.internal_probe = None
+        self.set_internal(reachable)
+
+    def set_internal(self, reachable: bool):
+        if reachable != self.internal_ok:
+            if reachable:
+                log.info(
+                    "Calling n8n on the internal path %s", self.valves.n8n_internal_url
+                )
+            else:
+                log.info(
+                    "Internal n8n path unreachable, calling %s", self.valves.n8n_url
+                )
+        self.internal_ok = reachable
+
+    def select_endpoint(self, exclude: list[Endpoint] = ()) -> Optional[Endpoint]:
+        """Pick an endpoint and count the call against it straight away."""
+        self.endpoints.configure(self.valves.n8n_urls or self.webhook_url())
+        endpoint = self.endpoints.select(
+            self.valves.balance_strategy, self.valves.breaker_reset_timeout, exclude
+        )
+        # Reserve before any await so concurrent selections see the load
+        if endpoint is not None:
+            endpoint.outstanding += 1
+        return endpoint
+
+    def release_endpoint(self, endpoint: Endpoint):
+        endpoint.outstanding -= 1
+
+    def endpoint_stats(self) -> list[dict]:
+        return [endpoint.stats() for endpoint in self.endpoints.endpoints]
+
+    @asynccontextmanager
+    async def tracked(self, endpoint: Endpoint):
+        """Report the outcome of one call to the endpoint's circuit breaker."""
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            endpoint.record_failure(self.valves.breaker_failure_threshold)
+            if (
+                isinstance(e, aiohttp.ClientConnectorError)
+                and endpoint.url == self.valves.n8n_internal_url
+            ):
+                # Fall back to the public URL until the next probe succeeds
+                self.set_internal(False)
+            raise
+        else:
+            endpoint.record_success(time.monotonic() - started)
+
+    async def call_endpoint(
+        self,
+        endpoint: Endpoint,
+        payload: dict,
+        headers: dict,
+        timings: Optional[dict] = None,
+    ) -> str:
+        if timings is not None:
+            timings["workflow"] = endpoint.url
+        async with self.tracked(endpoint), self.get_session().post(
+            endpoint.url,
+            json=payload,
+            headers=headers,
+            timeout=self.request_timeout(headers),
+            trace_request_ctx=timings,
+        ) as response:
+            if response.status != 200:
+                text = await response.text()
+                raise Exception(f"Error: {response.status} - {text}")
+            data = await response.json(content_type=None)
+            return data[self.valves.response_field]
+
+    async def call_hedged(
+        self,
+        payload: dict,
+        headers: dict,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+        timings: Optional[dict] = None,
+    ) -> str:
+        """Call one endpoint, retrying or hedging on another when enabled."""
+        attempts = 2 if self.valves.hedge_enabled else 1
+        used: list[Endpoint] = []
+        pending: set[asyncio.Task] = set()
+        error = None
+
+        def launch() -> bool:
+            endpoint = self.select_endpoint(exclude=used)
+            if endpoint is None:
+                return False
+            used.append(endpoint)
+            task = asyncio.ensure_future(
+                self.call_endpoint(endpoint, payload, headers, timings)
+            )
+            # A done callback runs even if the task is cancelled before it starts
+            task.add_done_callback(lambda _: self.release_endpoint(endpoint))
+            pending.add(task)
+            return True
+
+        if not launch():
+            raise Exception("No n8n endpoint available, all circuits are open")
+        try:
+            while pending:
+                # Hedge on another endpoint if the first is slow to answer
+                hedge = len(used) < attempts
+                done, _ = await asyncio.wait(
+                    pending,
+                    timeout=self.valves.hedge_delay if hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    pending.discard(task)
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                    # The request never reached n8n, so retrying is always safe
+                    if isinstance(error, aiohttp.ClientConnectorError):
+                        attempts = max(attempts, len(used) + 1)
+                if len(used) < attempts and (not done or not pending):
+                    if launch():
+                        await self.emit_status(
+                            __event_emitter__,
+                            "info",
+                            f"{'Retrying' if done else 'Hedging'} on {used[-1].url}",
+                            False,
+                        )
+                    else:
+                        attempts = len(used)
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def submit_job(
+        self, payload: dict, headers: dict, timings: Optional[dict] = None
+    ) -> str:
+        """Submit the payload to the job webhook and return the job id."""
+        endpoint = self.select_endpoint()
+        if endpoint is None:
+            raise Exception("No n8n endpoint available, all circuits are open")
+        if timings is not None:
+            timings["workflow"] = endpoint.url
+        try:
+            async with self.tracked(endpoint), self.get_session().post(
+                endpoint.url,
+                json=payload,
+                headers=headers,
+                timeout=self.request_timeout(headers),
+                trace_request_ctx=timings,
+            ) as response:
+                if response.status not in (200, 201, 202):
+                    text = await response.text()
+                    raise Exception(f"Error: {response.status} - {text}")
+                data = await response.json(content_type=None)
+        finally:
+            self.release_endpoint(endpoint)
+        if not data.get("jobId"):
+            raise Exception("The n8n job webhook did not return a jobId")
+        return str(data["jobId"])
+
+    async def poll_job(self, job_id: str, headers: dict) -> Optional[dict]:
+        """Fetch the job record, or None when n8n could not be reached."""
+        wait = self.valves.job_wait
+        remaining = self.remaining(headers)
+        if remaining is not None:
+            # Don't hold a long poll open past the request deadline
+            wait = max(min(wait, remaining), 0)
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=self.valves.connect_timeout,
+            sock_read=wait + self.valves.connect_timeout,
+        )
+        try:
+            async with self.get_session().get(
+                self.valves.job_result_url,
+                params={"jobId": job_id, "wait": f"{wait:g}"},
+                headers=headers,
+                timeout=timeout,
+            ) as response:
+                if response.status == 404:
+                    raise Exception(f"n8n does not know job {job_id}")
+                if response.status != 200:
+                    log.warning("Polling n8n job %s: HTTP %d", job_id, response.status)
+                    return None
+                return await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.warning("Polling n8n job %s failed: %r", job_id, e)
+            return None
+
+    async def run_job(
+        self,
+        payload: dict,
+        headers: dict,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+        timings: Optional[dict] = None,
+        beat: Optional[int] = None,
+    ) -> str:
+        """Submit a job, or resume a known one, and poll until it finishes."""
+        # Job ids outlive the request that submitted them, so a retried request
+        # picks up the running job instead of starting the workflow again
+        key = self.coalesce_key(payload)
+        job_id = self.jobs.get(key)
+        if job_id is None:
+            job_id = await self.submit_job(payload, headers, timings)
+            self.jobs[key] = job_id
+        else:
+            await self.emit_status(
+                __event_emitter__,
+                "info",
+                f"Resuming n8n job {job_id}",
+                False,
+                force=True,
+            )
+        deadline = time.monotonic() + self.valves.job_timeout
+        delay = self.valves.job_poll_interval
+        progress = None
+        while True:
+            try:
+                record = await self.poll_job(job_id, headers)
+            except Exception:
+                self.jobs.pop(key, None)
+                raise
+            status = (record or {}).get("status")
+            if status == "done":
+                self.jobs.pop(key, None)
+                return record[self.valves.response_field]
+            if status == "error":
+                self.jobs.pop(key, None)
+                raise Exception(record.get("error") or f"n8n job {job_id} failed")
+            if record and record.get("progress") and record["progress"] != progress:
+                progress = record["progress"]
+                # Keep reporting the workflow's own progress in the heartbeat
+                if beat in self.heartbeats:
+                    self.heartbeats[beat][2] = progress
+                await self.emit_status(
+                    __event_emitter__, "info", progress, False, force=True
+                )
+            if time.monotonic() + delay > deadline:
+                self.jobs.pop(key, None)
+                raise asyncio.TimeoutError(
+                    f"n8n job {job_id} did not finish within {self.valves.job_timeout:g}s"
+                )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.valves.job_poll_max_interval)
+
+    async def call_workflow(
+        self,
+        payload: dict,
+        headers: dict,
+        __user__: Optional[dict] = None,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+        timings: Optional[dict] = None,
+    ) -> str:
+        """Invoke the n8n webhook and return the buffered response field."""
+        async with self.admitted(__user__, __event_emitter__, timings, headers):
+            try:
+                with self.heartbeat(__event_emitter__) as beat:
+                    if self.valves.job_mode:
+                        return await self.run_job(
+                            payload, headers, __event_emitter__, timings, beat
+                        )
+                    return await self.call_hedged(
+                        payload, headers, __event_emitter__, timings
+                    )
+            except asyncio.CancelledError:
+                self.cancel_upstream(payload, headers)
+                raise
+
+    def cancel_upstream(self, payload: dict, headers: dict):
+        """Count an abandoned call and let n8n know so it can stop the execution."""
+        self.cancelled_calls += 1
+        request_id = headers.get("X-Request-Id")
+        log.info("Request %s was cancelled, aborting the n8n call", request_id)
+        if not self.valves.cancel_url:
+            return
+        notice = {"requestId": request_id, "sessionId": payload.get("sessionId")}
+        if self.valves.job_mode:
+            notice["jobId"] = self.jobs.pop(self.coalesce_key(payload), None)
+        # The caller is being cancelled, so send the notice from its own task
+        task = asyncio.ensure_future(self.notify_cancel(notice, headers))
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+
+    async def notify_cancel(self, notice: dict, headers: dict):
+        try:
+            async with self.get_session().post(
+                self.valves.cancel_url,
+                json=notice,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=self.valves.connect_timeout),
+            ) as response:
+                if response.status >= 400:
+                    log.warning(
+                        "Cancelling request %s in n8n: HTTP %d",
+                        notice["requestId"],
+                        response.status,
+                    )
+        except Exception as e:
+            log.warning(
+                "Cancelling request %s in n8n failed: %r", notice["requestId"], e
+            )
+
+    def coalesce_key(self, payload: dict) -> str:
+        question = payload[self.valves.input_field]
+        if self.valves.coalesce_scope == "question" and isinstance(question, str):
+            question = normalize_question(question)
+            key = json.dumps([self.valves.n8n_url, question])
+        else:
+            key = json.dumps([self.valves.n8n_url, payload], sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    async def call_workflow_coalesced(
+        self,
+        payload: dict,
+        headers: dict,
+        __user__: Optional[dict] = None,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+        timings: Optional[dict] = None,
+    ) -> str:
+        """Invoke the workflow, joining an identical call already in flight."""
+        if not self.valves.coalesce_enabled:
+            return await self.call_workflow(
+                payload, headers, __user__, __event_emitter__, timings
+            )
+        key = self.coalesce_key(payload)
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(
+                self.call_workflow(
+                    payload, headers, __user__, __event_emitter__, timings
+                )
+            )
+            self.inflight[key] = task
+
+            def forget(done_task: asyncio.Task):
+                if self.inflight.get(key) is done_task:
+                    del self.inflight[key]
+                # Mark the exception as retrieved even if every waiter went away
+                if not done_task.cancelled():
+                    done_task.exception()
+
+            task.add_done_callback(forget)
+            return await self.join(task)
+        self.coalesced_calls += 1
+        await self.emit_status(
+            __event_emitter__,
+            "info",
+            f"Joined an identical request in progress "
+            f"({self.coalesced_calls} upstream calls saved)",
+            False,
+            force=True,
+        )
+        # The leader's call reports to its own emitter, so beat for this waiter
+        with self.heartbeat(__event_emitter__):
+            return await self.join(task)
+
+    async def join(self, task: asyncio.Task) -> str:
+        """Wait for a shared call, cancelling it when the last waiter goes away."""
+        self.waiters[task] = self.waiters.get(task, 0) + 1
+        try:
+            # Shield the shared call so one waiter going away does not fail the rest
+            return await asyncio.shield(task)
+        finally:
+            self.waiters[task] -= 1
+            if not self.waiters[task]:
+                del self.waiters[task]
+                task.cancel()
+
+    async def iter_response_text(
+        self, response: aiohttp.ClientResponse
+    ) -> AsyncGenerator[str, None]:
+        """Yield text from a streaming (SSE, NDJSON or chunked) or buffered body."""
+        content_type = response.headers.get("Content-Type", "")
+        field = self.valves.response_field
+        if "text/event-stream" in content_type:
+            async for line in iter_lines(response):
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:") :].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    text = extract_stream_text(json.loads(data), field)
+                except ValueError:
+                    text = data
+                if text:
+                    yield text
+        elif "json" in content_type:
+            # n8n streams one JSON item per line; a webhook that does not stream
+            # sends a single document instead, which is parsed once complete
+            buffered = []
+            async for line in iter_lines(response):
+                if buffered:
+                    buffered.append(line)
+                    continue
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    buffered.append(line)
+                    continue
+                text = extract_stream_text(item, field)
+                if text:
+                    yield text
+            if buffered:
+                text = extract_stream_text(json.loads(b"\n".join(buffered)), field)
+                if text:
+                    yield text
+        else:
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            async for data in response.content.iter_any():
+                text = decoder.decode(data)
+                if text:
+                    yield text
+            text = decoder.decode(b"", final=True)
+            if text:
+                yield text
+
+    async def stream_workflow(
+        self,
+        body: dict,
+        payload: dict,
+        headers: dict,
+        __user__: Optional[dict] = None,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+        remember: Optional[Callable[[str], None]] = None,
+    ) -> AsyncGenerator[str, None]:
+        chunks = []
+        timings = {}
+        started = time.monotonic()
+        try:
+            async with self.admitted(__user__, __event_emitter__, timings, headers):
+                endpoint = self.select_endpoint()
+                if endpoint is None:
+                    raise Exception("No n8n endpoint available, all circuits are open")
+                timings["workflow"] = endpoint.url
+                try:
+                    with self.heartbeat(__event_emitter__) as beat:
+                        async with self.tracked(endpoint), self.get_session().post(
+                            endpoint.url,
+                            json=payload,
+                            headers=headers,
+                            timeout=self.request_timeout(headers),
+                            trace_request_ctx=timings,
+                        ) as response:
+                            if response.status != 200:
+                                text = await response.text()
+                                raise Exception(f"Error: {response.status} - {text}")
+                            async for text in self.iter_response_text(response):
+                                # The answer itself shows progress from here on
+                                self.heartbeats.pop(beat, None)
+                                chunks.append(text)
+                                yield text
+                except (asyncio.CancelledError, GeneratorExit):
+                    # Open WebUI stops reading when the user hits stop
+                    self.cancel_upstream(payload, headers)
+                    raise
+                finally:
+                    self.release_endpoint(endpoint)
+
+            # Set assitant message with chain reply
+            n8n_response = "".join(chunks)
+            timings.setdefault("size", len(n8n_response.encode("utf-8")))
+            body["messages"].append({"role": "assistant", "content": n8n_response})
+            if remember is not None:
+                remember(n8n_response)
+        except (asyncio.CancelledError, GeneratorExit):
+            self.record_request(timings, started, "cancelled")
+            raise
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError) and self.deadline_passed(headers):
+                e = self.deadline_error("while streaming")
+            self.record_request(timings, started, request_outcome(e))
+            await self.emit_status(
+                __event_emitter__,
+                "error",
+                f"Error during sequence execution: {str(e)}",
+                True,
+            )
+            return
+        self.record_request(timings, started, "ok")
+        await self.emit_status(__event_emitter__, "info", "Complete", True)
 
     async def pipe(
         self,
@@ -80,7 +1986,9 @@ class Pipe:
         __user__: Optional[dict] = None,
         __event_emitter__: Callable[[dict], Awaitable[None]] = None,
         __event_call__: Callable[[dict], Awaitable[dict]] = None,
-    ) -> Optional[dict]:
+    ) -> Optional[dict | str | AsyncGenerator[str, None]]:
+        await self.start_metrics_listener()
+        await self.check_internal()
         await self.emit_status(
             __event_emitter__, "info", "/Calling N8N Workflow...", False
         )
@@ -90,25 +1998,88 @@ class Pipe:
         # Verify a message is available
         if messages:
             question = messages[-1]["content"]
+            # Multimodal turns arrive as a list of parts; only plain text can be
+            # routed or cached, so anything with images goes to the workflow as is
+            text = message_text(question)
+            if text is not None:
+                question = text
+            prefix = self.valves.cache_bypass_prefix
+            refresh = (
+                bool(prefix) and text is not None and text.lstrip().startswith(prefix)
+            )
+            if refresh:
+                question = text = text.lstrip()[len(prefix) :].lstrip()
+            headers = {
+                "Authorization": f"Bearer {self.valves.n8n_bearer_token}",
+                "Content-Type": "application/json",
+                "X-Request-Id": uuid.uuid4().hex,
+            }
+            if self.valves.request_deadline > 0:
+                # Absolute Unix time, so workflows can skip optional steps late on
+                deadline = time.time() + self.valves.request_deadline
+                headers["X-Request-Deadline"] = f"{deadline:.3f}"
+            payload = {"sessionId": f"{chat_id}"}
+            payload[self.valves.input_field] = question
+
+            # Small talk doesn't need the agent, its memory or the vector store
+            route = "workflow"
+            if self.valves.router_enabled and text is not None:
+                route = await self.route(
+                    question, messages[:-1], headers, __user__, __event_emitter__
+                )
+            if route == "fast":
+                n8n_response = await self.answer_fast(
+                    body, payload, headers, __user__, __event_emitter__
+                )
+                if n8n_response is not None:
+                    body["messages"].append(
+                        {"role": "assistant", "content": n8n_response}
+                    )
+                    await self.emit_status(
+                        __event_emitter__, "info", "Complete (fast path)", True
+                    )
+                    return n8n_response
+
+            # Serve repeated questions from the cache unless the request opts out
+            remember = None
+            if body.get("cache", True) and text is not None:
+                n8n_response, remember = await self.lookup_cached(
+                    question, payload["sessionId"], refresh
+                )
+                if n8n_response is not None:
+                    body["messages"].append(
+                        {"role": "assistant", "content": n8n_response}
+                    )
+                    await self.emit_status(
+                        __event_emitter__, "info", "Complete (cached)", True
+                    )
+                    return n8n_response
+
+            if self.valves.stream and not self.valves.job_mode:
+                return self.stream_workflow(
+                    body, payload, headers, __user__, __event_emitter__, remember
+                )
+            timings = {}
+            started = time.monotonic()
             try:
                 # Invoke N8N workflow
-                headers = {
-                    "Authorization": f"Bearer {self.valves.n8n_bearer_token}",
-                    "Content-Type": "application/json",
-                }
-                payload = {"sessionId": f"{chat_id}"}
-                payload[self.valves.input_field] = question
-                response = requests.post(
-                    self.valves.n8n_url, json=payload, headers=headers
+                n8n_response = await self.within_deadline(
+                    self.call_workflow_coalesced(
+                        payload, headers, __user__, __event_emitter__, timings
+                    ),
+                    headers,
                 )
-                if response.status_code == 200:
-                    n8n_response = response.json()[self.valves.response_field]
-                else:
-                    raise Exception(f"Error: {response.status_code} - {response.text}")
+                self.record_request(timings, started, "ok")
+                if remember is not None:
+                    remember(n8n_response)
 
                 # Set assitant message with chain reply
                 body["messages"].append({"role": "assistant", "content": n8n_response})
+            except asyncio.CancelledError:
+                self.record_request(timings, started, "cancelled")
+                raise
             except Exception as e:
+                self.record_request(timings, started, request_outcome(e))
                 await self.emit_status(
                     __event_emitter__,
                     "error",
@@ -18,13 +18,109 @@ import platform
 import sys
 import secrets
 import string
+import json
+import hashlib
+import threading
+import urllib.request
+import statistics
+import re
 import jwt
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from cloudflare_setup import main as setup_cloudflare
 import random
-from typing import List, Dict
+from typing import List, Dict, Optional, Union
 from pathlib import Path
 
+PROJECT_NAME = "localai"
+# Override to point the script at a wrapper or a fake docker CLI for testing
+DOCKER = os.environ.get("LOCALAI_DOCKER", "docker")
+COMPOSE_FILES = [
+    "docker-compose.yml",
+    os.path.join("supabase", "docker", "docker-compose.yml"),
+]
+
+# Compose services behind each entry of the service selection menu.
+# Supabase owns every service in its own compose file.
+SERVICE_GROUPS = {
+    "N8N (Workflow Automation)": ["n8n", "n8n-import"],
+    "Open WebUI (Chat Interface)": ["open-webui"],
+    "Flowise (Visual Programming)": ["flowise"],
+    "Qdrant (Vector Database)": ["qdrant"],
+    "Redis (Cache)": ["redis"],
+    "SearXNG (Search Engine)": ["searxng"],
+    "Ollama (Local LLM)": ["ollama", "ollama-gpu", "ollama-gpu-amd", "ollama-pull-llama-cpu",
+                           "ollama-pull-llama-gpu", "ollama-pull-llama-gpu-amd"],
+    "Cloudflared (Secure Access)": ["cloudflared"],
+}
+
+# Dependencies compose can't express because the services live in different files
+CROSS_FILE_DEPENDENCIES = {
+    "n8n": {"db": "service_healthy"},
+}
+
+# Active readiness probes, tried every second while a service starts so we don't
+# wait for Docker's 30s healthcheck interval. A URL is fetched from the host; a
+# command runs inside the service's container.
+READINESS_PROBES = {
+    "db": ["pg_isready", "-U", "postgres", "-h", "localhost"],
+    "redis": ["sh", "-c", 'redis-cli -a "$REDIS_PASSWORD" --no-auth-warning ping | grep -q PONG'],
+    "n8n": "http://localhost:5678/healthz",
+    "open-webui": "http://localhost:3000/health",
+    "flowise": "http://localhost:3001/api/v1/ping",
+    "qdrant": "http://localhost:6333/healthz",
+    "searxng": "http://localhost:8080/healthz",
+    "ollama": "http://localhost:11434/api/version",
+    "ollama-gpu": "http://localhost:11434/api/version",
+    "ollama-gpu-amd": "http://localhost:11434/api/version",
+}
+
+# One Ollama service per profile, all sharing the ollama-data volume
+OLLAMA_SERVICES = ["ollama", "ollama-gpu", "ollama-gpu-amd"]
+# Pull the models for plain docker compose; the model stage here replaces them
+OLLAMA_PULLERS = ["ollama-pull-llama-cpu", "ollama-pull-llama-gpu", "ollama-pull-llama-gpu-amd"]
+OLLAMA_URL = "http://localhost:11434"
+OLLAMA_MODELS_DIR = "/root/.ollama/models"  # Inside the container
+MODEL_MANIFEST = "ollama_models.json"
+OLLAMA_TUNING_REPORT = "ollama_tuning.json"
+
+# Fixed workload for --tune-ollama, so that trials can be compared
+TUNE_PROMPTS = [
+    "Summarise in two sentences why vector databases are used for retrieval augmented generation.",
+    "Write a Python function that checks whether a string is a palindrome.",
+    "List three differences between PostgreSQL and Redis.",
+    "Explain what a webhook is to someone who doesn't write code.",
+    "Translate 'The meeting has moved to Thursday afternoon' into German and French.",
+    "What are the trade-offs of running language models on a CPU?",
+]
+TUNE_CONCURRENCY = [1, 2, 4]
+TUNE_TOKENS = 64
+TUNE_MIN_GAIN = 0.03  # Smaller differences are within run-to-run noise
+
+# Compose overrides with the generated tuning, layered over the file they extend.
+# Both live here because supabase/ is only cloned after the .env is created.
+TUNING_OVERRIDES = {
+    COMPOSE_FILES[0]: "docker-compose.tuning.yml",
+    COMPOSE_FILES[1]: "docker-compose.supabase-tuning.yml",
+}
+# The db command from Supabase's compose file, which the override has to repeat
+SUPABASE_DB_COMMAND = ["postgres", "-c", "config_file=/etc/postgresql/postgresql.conf",
+                       "-c", "log_min_messages=fatal"]
+POSTGRES_MAX_CONNECTIONS = 100  # Supabase's default
+# Shares of RAM for the databases; Ollama's models need most of the rest
+POSTGRES_MEMORY_SHARE = 0.25
+REDIS_MEMORY_SHARE = 0.05
+
+TIMINGS_LOG = "startup_timings.jsonl"
+STATE_FILE = "startup_state.json"
+
+# Readiness timeouts for services slower than --health-timeout allows for
+SERVICE_TIMEOUTS = {
+    "open-webui": 600,  # Downloads its embedding model on first start
+    "db": 600,  # Runs the Supabase migrations on first start
+}
+
 def print_banner():
     banner = r"""
     ██╗      ██████╗  ██████╗ █████╗ ██╗         █████╗ ██╗
@@ -54,6 +150,141 @@ def print_section(title):
     print(f"\033[35m[  {title}  ]\033[0m")
     print(f"\033[35m{'=' * 60}\033[0m\n")
 
+def host_memory() -> Optional[int]:
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None  # Not available on Windows
+
+def cpu_features() -> List[str]:
+    """The CPU's SIMD extensions, which decide how fast models run without a GPU."""
+    wanted = ['avx', 'avx2', 'avx512f', 'avx512_vnni', 'avx_vnni', 'fma', 'f16c',
+              'asimd', 'sve', 'neon']
+    flags = set()
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key.strip() in ('flags', 'Features'):
+                    flags.update(value.split())
+    except OSError:
+        try:
+            # macOS on Intel lists them as e.g. AVX1.0 AVX2 FMA
+            result = subprocess.run(['sysctl', '-n', 'machdep.cpu.features',
+                                     'machdep.cpu.leaf7_features'], capture_output=True, text=True)
+            flags.update(flag.split('.')[0].replace('avx1', 'avx')
+                         for flag in result.stdout.lower().split())
+        except OSError:
+            pass
+        if platform.machine() == 'arm64':
+            flags.add('neon')  # Every Apple Silicon chip has it
+    return [flag for flag in wanted if flag in flags]
+
+def host_resources() -> Dict:
+    """Describe the host's CPU and memory for the timing log."""
+    ram = host_memory()
+    return {
+        "cpus": os.cpu_count(),
+        "ram_gb": round(ram / 1024 ** 3, 1) if ram else None,
+        "cpu_features": cpu_features(),
+        "platform": platform.platform(),
+    }
+
+def docker_resources() -> Dict:
+    """CPUs and memory containers can use, less than the host's under Docker Desktop."""
+    host = host_resources()
+    hardware = {'cpus': host['cpus'] or 1, 'ram': host_memory(), 'cpu_features': host['cpu_features']}
+    try:
+        result = subprocess.run([DOCKER, 'info', '--format', '{{json .}}'],
+                                capture_output=True, text=True)
+        info = json.loads(result.stdout)
+        hardware['cpus'] = info.get('NCPU') or hardware['cpus']
+        hardware['ram'] = info.get('MemTotal') or hardware['ram']
+    except (OSError, ValueError):
+        pass
+    return hardware
+
+class PhaseProfiler:
+    """Times the phases of one startup run and appends them to the timing log."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases: Dict[str, float] = {}
+        self.failed: List[str] = []
+        self.services: List[str] = []
+        self.profile = None
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.monotonic()
+        try:
+            yield
+        except BaseException:
+            self.failed.append(name)
+            raise
+        finally:
+            self.record(name, time.monotonic() - started)
+
+    @contextmanager
+    def paused(self):
+        """Leave a stretch out of the run's total, e.g. waiting for user input."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.started += time.monotonic() - started
+
+    def record(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def save(self, path: str = TIMINGS_LOG):
+        record = {
+            "time": datetime.now().isoformat(timespec='seconds'),
+            "profile": self.profile,
+            "services": self.services,
+            "host": host_resources(),
+            "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            "failed": self.failed,
+            "total": round(time.monotonic() - self.started, 3),
+        }
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+def print_timings_report(path: str = TIMINGS_LOG) -> None:
+    """Compare the latest startup run against the median of earlier ones."""
+    print_section("STARTUP TIMINGS")
+    try:
+        with open(path) as f:
+            runs = [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        runs = []
+    if not runs:
+        print_status(f"No startup timings recorded yet in {path}", "WARN")
+        return
+    latest = runs[-1]
+    history = [run for run in runs[:-1] if run.get('profile') == latest.get('profile')]
+    print(f"Latest run {latest['time']} (profile {latest.get('profile')}, "
+          f"{latest['host'].get('cpus')} CPUs, {latest['host'].get('ram_gb')} GB RAM) "
+          f"against {len(history)} earlier runs\n")
+    print(f"  {'phase':<28} {'latest':>9} {'median':>9} {'change':>8}")
+    phases = dict(latest['phases'], total=latest['total'])
+    for name, seconds in phases.items():
+        past = [run['total'] if name == 'total' else run['phases'][name]
+                for run in history if name == 'total' or name in run['phases']]
+        if not past:
+            print(f"  {name:<28} {seconds:8.1f}s {'-':>9} {'-':>8}")
+            continue
+        median = statistics.median(past)
+        change = (seconds - median) / median * 100 if median else 0.0
+        line = f"  {name:<28} {seconds:8.1f}s {median:8.1f}s {change:+7.0f}%"
+        # Flag phases that got noticeably slower, ignoring sub-second noise
+        if seconds - median > 1 and change > 25:
+            print(f"\033[31m{line}  << regression\033[0m")
+        else:
+            print(line)
+    if latest.get('failed'):
+        print_status(f"Failed phases in the latest run: {', '.join(latest['failed'])}", "WARN")
+
 def print_matrix_line():
     chars = "░▒▓█"
     line = "".join(random.choice(chars) for _ in range(60))
@@ -100,6 +331,141 @@ def generate_api_key() -> str:
     """Generate a secure API key."""
     return secrets.token_urlsafe(32)
 
+def tuning_values(cpus: int, ram: Optional[int]) -> Dict[str, str]:
+    """Derive Postgres, Supavisor and Redis settings from the CPUs and RAM available."""
+    mb = 1024 ** 2
+    ram = ram or 8 * 1024 ** 3  # Assume a modest machine when it can't be detected
+    budget = ram * POSTGRES_MEMORY_SHARE
+    shared_buffers = max(budget / 4, 128 * mb)
+    per_gather = max(1, min(4, cpus // 2))
+    # Each connection may run a few sorts or hashes at once, each in parallel
+    work_mem = (budget - shared_buffers) / (POSTGRES_MAX_CONNECTIONS * 3) / per_gather
+    # Connections beyond about two per core only queue up inside Postgres
+    pool_size = min(max(cpus * 2, 10), POSTGRES_MAX_CONNECTIONS // 2)
+
+    def size(value: float) -> str:
+        return f"{int(value // mb)}MB"
+
+    return {
+        'POSTGRES_SHARED_BUFFERS': size(shared_buffers),
+        'POSTGRES_EFFECTIVE_CACHE_SIZE': size(max(budget * 3 / 4, 512 * mb)),
+        'POSTGRES_WORK_MEM': size(max(work_mem, 4 * mb)),
+        'POSTGRES_MAINTENANCE_WORK_MEM': size(min(max(budget / 16, 64 * mb), 2048 * mb)),
+        # Supabase's extensions run background workers of their own
+        'POSTGRES_MAX_WORKER_PROCESSES': str(cpus + 8),
+        'POSTGRES_MAX_PARALLEL_WORKERS': str(cpus),
+        'POSTGRES_MAX_PARALLEL_WORKERS_PER_GATHER': str(per_gather),
+        'POOLER_DEFAULT_POOL_SIZE': str(pool_size),
+        'POOLER_MAX_CLIENT_CONN': str(min(max(pool_size * 10, 100), 1000)),
+        'REDIS_MAXMEMORY': size(min(max(ram * REDIS_MEMORY_SHARE, 64 * mb), 4096 * mb)),
+    }
+
+def postgres_override() -> Dict[str, Dict]:
+    """The db service's command with the tuned settings read from .env."""
+    settings = {
+        'shared_buffers': 'POSTGRES_SHARED_BUFFERS',
+        'effective_cache_size': 'POSTGRES_EFFECTIVE_CACHE_SIZE',
+        'work_mem': 'POSTGRES_WORK_MEM',
+        'maintenance_work_mem': 'POSTGRES_MAINTENANCE_WORK_MEM',
+        'max_worker_processes': 'POSTGRES_MAX_WORKER_PROCESSES',
+        'max_parallel_workers': 'POSTGRES_MAX_PARALLEL_WORKERS',
+        'max_parallel_workers_per_gather': 'POSTGRES_MAX_PARALLEL_WORKERS_PER_GATHER',
+    }
+    command = list(SUPABASE_DB_COMMAND)
+    for setting, variable in settings.items():
+        command += ['-c', f"{setting}=${{{variable}}}"]
+    return {'db': {'command': command}}
+
+def base_services(compose_file: str) -> Optional[List[str]]:
+    """Services a compose file defines itself, in any profile, without its override."""
+    if not os.path.exists(compose_file):
+        return []
+    try:
+        result = subprocess.run(
+            [DOCKER, 'compose', '-p', PROJECT_NAME, '-f', compose_file, '--profile', '*',
+             'config', '--services'],
+            env=compose_env(), check=True, capture_output=True, text=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.split()
+
+def load_override(path: str) -> Dict:
+    try:
+        with open(path) as f:
+            return json.loads(''.join(line for line in f if not line.startswith('#')))
+    except (FileNotFoundError, ValueError):
+        return {'services': {}}
+
+def write_override(compose_file: str, services: Dict[str, Dict]) -> None:
+    """Merge service settings into the generated override of a compose file.
+
+    Services the base file doesn't define are refused, and dropped if an earlier
+    run wrote them: compose would otherwise add them as services without an image.
+    """
+    path = TUNING_OVERRIDES[compose_file]
+    defined = base_services(compose_file)
+    if defined is None:
+        print_status(f"Could not read the services of {compose_file}; leaving {path} as it is", "WARN")
+        return
+    override = load_override(path)
+    for name in services:
+        if name not in defined:
+            print_status(f"{compose_file} defines no {name} service, not overriding it", "WARN")
+    override['services'] = {
+        name: settings for name, settings in override.get('services', {}).items() if name in defined
+    }
+    for name, settings in services.items():
+        if name in defined:
+            override['services'].setdefault(name, {}).update(settings)
+    if not override['services']:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, 'w') as f:
+        f.write(f"# Generated by start_services.py --tune-only/--tune-ollama for {compose_file}; "
+                "rerun those instead of editing\n")
+        json.dump(override, f, indent=2)  # JSON is valid YAML
+        f.write("\n")
+
+def update_env_file(values: Dict[str, str], path: str = '.env') -> None:
+    """Set keys in an env file in place, appending the ones it doesn't have yet."""
+    with open(path) as f:
+        lines = f.read().splitlines()
+    pending = dict(values)
+    for index, line in enumerate(lines):
+        key = line.split('=', 1)[0].strip()
+        if '=' in line and not line.startswith('#') and key in pending:
+            lines[index] = f"{key}={pending.pop(key)}"
+    if pending:
+        lines += ['', '# Hardware tuning, regenerate with: python start_services.py --tune-only']
+        lines += [f"{key}={value}" for key, value in pending.items()]
+    with open(path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+def tune_for_host() -> Dict[str, str]:
+    """Write settings sized for this machine to .env and the compose overrides."""
+    hardware = docker_resources()
+    values = tuning_values(hardware['cpus'], hardware['ram'])
+    update_env_file(values)
+    if 'db' in (base_services(COMPOSE_FILES[1]) or []):
+        write_override(COMPOSE_FILES[1], postgres_override())
+    else:
+        print_status(f"{COMPOSE_FILES[1]} defines no db service, so the Postgres settings are only "
+                     "written to .env; rerun --tune-only once it does", "WARN")
+        write_override(COMPOSE_FILES[1], {})  # Drops a db override left by an earlier run
+    if os.path.isdir(os.path.join('supabase', 'docker')):
+        shutil.copy2('.env', os.path.join('supabase', 'docker', '.env'))
+
+    ram = f"{hardware['ram'] / 1024 ** 3:.1f} GB" if hardware['ram'] else "unknown"
+    features = ', '.join(hardware['cpu_features']) or 'none detected'
+    print_status(f"Tuned for {hardware['cpus']} CPUs and {ram} RAM (CPU features: {features})", "OK")
+    for key, value in values.items():
+        print(f"  {key:<42} {value}")
+    if platform.machine() in ('x86_64', 'AMD64') and 'avx2' not in hardware['cpu_features']:
+        print_status("This CPU has no AVX2, so Ollama will run models slowly on it", "WARN")
+    return values
+
 def create_env_file():
     """Create a .env file with secure random values."""
     env_vars = {
@@ -133,10 +499,8 @@ def create_env_file():
         'DASHBOARD_PASSWORD': generate_secure_string(16),
         'POOLER_TENANT_ID': '1000',
 
-        # Supavisor Configuration
+        # Supavisor Configuration (pool sizes are added by tune_for_host)
         'POOLER_PROXY_PORT_TRANSACTION': '6543',
-        'POOLER_DEFAULT_POOL_SIZE': '20',
-        'POOLER_MAX_CLIENT_CONN': '100',
         'SECRET_KEY_BASE': generate_secure_string(64),
         'VAULT_ENC_KEY': generate_secure_string(32),
 
@@ -368,83 +732,1112 @@ def select_services() -> Dict[str, bool]:
     
     return services
 
-def start_services(selected_services: Dict[str, bool], use_cloudflare: bool = False) -> None:
-    """Start the selected services with proper environment variables."""
-    try:
-        # Ensure .env file exists and copy it to supabase/docker/.env
-        if os.path.exists('.env'):
-            shutil.copy2('.env', 'supabase/docker/.env')
+def compose_command(compose_file: str, profiles: List[str], *args) -> List[str]:
+    """Build a docker compose command for one of the stack's compose files."""
+    cmd = [DOCKER, 'compose', '-p', PROJECT_NAME, '-f', compose_file]
+    override = TUNING_OVERRIDES.get(compose_file)
+    if override and os.path.exists(override):
+        cmd.extend(['-f', override])
+    for profile in profiles:
+        cmd.extend(['--profile', profile])
+    return cmd + list(args)
+
+def compose_env() -> Dict[str, str]:
+    env = os.environ.copy()
+    env.setdefault('tmp', '/tmp')  # Referenced by the Supabase compose file
+    return env
+
+def load_service_graph(profiles: List[str]) -> Dict[str, Dict]:
+    """Render both compose files and return every service with its dependencies."""
+    graph = {}
+    for compose_file in COMPOSE_FILES:
+        if not os.path.exists(compose_file):
+            continue
+        result = subprocess.run(
+            compose_command(compose_file, profiles, 'config', '--format', 'json'),
+            env=compose_env(), check=True, capture_output=True, text=True
+        )
+        config = json.loads(result.stdout)
+        for name, service in config.get('services', {}).items():
+            depends_on = service.get('depends_on') or {}
+            if isinstance(depends_on, list):
+                depends_on = {dep: {'condition': 'service_started'} for dep in depends_on}
+            graph[name] = {
+                'file': compose_file,
+                'config': service,
+                'depends_on': {dep: opts.get('condition', 'service_started')
+                               for dep, opts in depends_on.items()},
+                'healthcheck': bool(service.get('healthcheck'))
+                               and not service['healthcheck'].get('disable'),
+            }
+    for name, extra in CROSS_FILE_DEPENDENCIES.items():
+        if name in graph:
+            for dep, condition in extra.items():
+                if dep in graph:
+                    graph[name]['depends_on'].setdefault(dep, condition)
+    return graph
+
+def resolve_services(selected_services: Dict[str, bool], graph: Dict[str, Dict]) -> List[str]:
+    """Map the menu selection to compose services, adding their dependencies."""
+    grouped = {name for names in SERVICE_GROUPS.values() for name in names}
+    wanted = set()
+    for name, info in graph.items():
+        if info['file'] != COMPOSE_FILES[0]:
+            group = "Supabase (Database & Vector Store)"
+        elif name in grouped:
+            group = next(g for g, names in SERVICE_GROUPS.items() if name in names)
         else:
-            print("[ERROR] .env file not found. Please run the script again to generate it.")
+            group = None  # Shared infrastructure such as Caddy always runs
+        if group is None or selected_services.get(group, False):
+            wanted.add(name)
+    pending = list(wanted)
+    while pending:
+        for dep in graph[pending.pop()]['depends_on']:
+            if dep in graph and dep not in wanted:
+                wanted.add(dep)
+                pending.append(dep)
+    return sorted(wanted)
+
+def start_waves(graph: Dict[str, Dict], services: List[str]) -> List[List[str]]:
+    """Group services into waves whose members only depend on earlier waves."""
+    remaining = {name: {dep for dep in graph[name]['depends_on'] if dep in services}
+                 for name in services}
+    waves = []
+    while remaining:
+        wave = sorted(name for name, deps in remaining.items() if not deps)
+        if not wave:
+            raise ValueError(f"Dependency cycle between: {', '.join(sorted(remaining))}")
+        waves.append(wave)
+        for name in wave:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(wave)
+    return waves
+
+def ready_condition(graph: Dict[str, Dict], service: str, services: List[str]) -> str:
+    """The strictest condition any dependent waits for, or health if it has a check."""
+    conditions = {graph[name]['depends_on'][service] for name in services
+                  if service in graph[name]['depends_on']}
+    if 'service_completed_successfully' in conditions:
+        return 'service_completed_successfully'
+    if 'service_healthy' in conditions or graph[service]['healthcheck']:
+        return 'service_healthy'
+    return 'service_started'
+
+def service_container(service: str) -> Optional[str]:
+    result = subprocess.run(
+        [DOCKER, 'ps', '-a', '-q',
+         '--filter', f'label=com.docker.compose.project={PROJECT_NAME}',
+         '--filter', f'label=com.docker.compose.service={service}'],
+        capture_output=True, text=True
+    )
+    return result.stdout.split()[0] if result.stdout.split() else None
+
+def service_state(service: str) -> Optional[Dict]:
+    """Return the Docker state of a service's container, if it has one."""
+    container = service_container(service)
+    if container is None:
+        return None
+    result = subprocess.run([DOCKER, 'inspect', '--format', '{{json .State}}', container],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return dict(json.loads(result.stdout), Id=container[:12])
+
+def run_probe(service: str, probe) -> bool:
+    """Run one active readiness probe, returning True once it passes."""
+    try:
+        if isinstance(probe, str):
+            with urllib.request.urlopen(probe, timeout=2) as response:
+                return response.status < 400
+        container = service_container(service)
+        if container is None:
             return False
+        result = subprocess.run([DOCKER, 'exec', container] + probe,
+                                capture_output=True, timeout=10)
+        return result.returncode == 0
+    except Exception:
+        return False
 
-        # Stop existing containers first
-        try:
-            subprocess.run(['docker', 'compose', '-p', 'localai', 'down'], check=True)
-        except subprocess.CalledProcessError:
-            pass  # Ignore errors if no containers are running
+def is_ready(state: Optional[Dict], condition: str) -> Optional[bool]:
+    """True when the condition holds, False when it never will, None to keep waiting."""
+    if state is None:
+        return None
+    exited = state.get('Status') == 'exited'
+    if condition == 'service_completed_successfully':
+        return state.get('ExitCode') == 0 if exited else None
+    if exited and state.get('ExitCode') != 0:
+        return False
+    if condition == 'service_healthy':
+        health = (state.get('Health') or {}).get('Status')
+        if health == 'healthy' or (state.get('Probed') and state.get('Running')):
+            return True
+        return False if health == 'unhealthy' else None
+    return state.get('Running') or exited or None
+
+class ReadinessWatcher:
+    """Follows the docker events stream so waiters wake the moment a service is ready."""
+
+    def __init__(self, probes: bool = True):
+        self.probes = probes
+        self.states: Dict[str, Dict] = {}
+        self.changed = threading.Condition()
+        self.process = None
 
-        # Start Supabase services first if selected
-        if 'supabase' in selected_services:
-            print("[INFO] Activating quantum database matrix...")
+    def start(self):
+        self.process = subprocess.Popen(
+            [DOCKER, 'events', '--format', '{{json .}}',
+             '--filter', 'type=container',
+             '--filter', f'label=com.docker.compose.project={PROJECT_NAME}'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+        )
+        threading.Thread(target=self.read_events, daemon=True).start()
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+    def read_events(self):
+        for line in self.process.stdout:
             try:
-                # Set environment variables explicitly
-                env = os.environ.copy()
-                env.update({
-                    'POSTGRES_PASSWORD': os.getenv('POSTGRES_PASSWORD', 'postgres'),
-                    'LOGFLARE_API_KEY': os.getenv('LOGFLARE_API_KEY', ''),
-                    'LOGFLARE_SOURCE_ID': os.getenv('LOGFLARE_SOURCE_ID', ''),
-                    'tmp': '/tmp'  # Add the missing tmp variable
-                })
-                
-                # Start Supabase services
+                event = json.loads(line)
+            except ValueError:
+                continue
+            actor = event.get('Actor') or {}
+            attributes = actor.get('Attributes') or {}
+            service = attributes.get('com.docker.compose.service')
+            container = actor.get('ID') or event.get('id')
+            if service:
+                self.update(service, event.get('Action') or event.get('status', ''), attributes,
+                            container[:12] if container else None)
+
+    def update(self, service: str, action: str, attributes: Dict = {},
+               container: Optional[str] = None):
+        with self.changed:
+            state = self.states.setdefault(service, {})
+            if action == 'start':
+                state.clear()
+                state.update(Id=container, Status='running', Running=True, ExitCode=0)
+            elif container and state.get('Id') and container != state['Id']:
+                # A recreated service's old container can die after the new one started
+                return
+            elif action == 'die':
+                state.update(Status='exited', Running=False, Probed=False,
+                             ExitCode=int(attributes.get('exitCode', 0)))
+            elif action.startswith('health_status'):
+                state['Health'] = {'Status': action.split(':', 1)[-1].strip()}
+            elif action == 'probe_ok':
+                state['Probed'] = True
+            else:
+                return
+            self.changed.notify_all()
+
+    def probe(self, service: str, deadline: float, done: threading.Event):
+        while not done.is_set() and time.monotonic() < deadline:
+            if run_probe(service, READINESS_PROBES[service]):
+                self.update(service, 'probe_ok')
+                return
+            done.wait(1.0)
+
+    def wait(self, service: str, condition: str, timeout: float) -> bool:
+        """Block until the service meets the condition, fails, or times out."""
+        deadline = time.monotonic() + timeout
+        # The container may have settled before we subscribed, so seed from inspect
+        current = service_state(service)
+        with self.changed:
+            known = self.states.get(service)
+            if current is not None and (known is None or known.get('Id') != current['Id']):
+                self.states[service] = current
+        done = threading.Event()
+        if self.probes and condition == 'service_healthy' and service in READINESS_PROBES:
+            threading.Thread(target=self.probe, args=(service, deadline, done), daemon=True).start()
+        try:
+            with self.changed:
+                while True:
+                    ready = is_ready(self.states.get(service), condition)
+                    if ready is not None:
+                        return ready
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self.changed.wait(remaining)
+        finally:
+            done.set()
+
+def local_image(image: str) -> Optional[Dict]:
+    """Return the ID and registry digests of a local image, or None if missing."""
+    result = subprocess.run([DOCKER, 'image', 'inspect', '--format', '{{json .}}', image],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    info = json.loads(result.stdout)
+    return {'id': info.get('Id'), 'digests': info.get('RepoDigests') or []}
+
+def remote_digest(image: str) -> Optional[str]:
+    """Ask the registry for the digest a tag currently points to."""
+    result = subprocess.run(
+        [DOCKER, 'buildx', 'imagetools', 'inspect', image, '--format', '{{json .Manifest}}'],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        return None
+    try:
+        return json.loads(result.stdout).get('digest')
+    except ValueError:
+        return None
+
+def images_to_pull(images: List[str], max_age: float, workers: int) -> Dict[str, str]:
+    """Return the images that are missing or outdated, with the reason.
+
+    Registry lookups are cached in the state file for max_age seconds, so a
+    restart with every image present doesn't touch the network at all.
+    """
+    state = load_state()
+    cache = state.setdefault('images', {})
+    now = time.time()
+
+    def check(image: str) -> Optional[str]:
+        local = local_image(image)
+        if local is None:
+            return "missing"
+        cached = cache.get(image, {})
+        if now - cached.get('checked', 0) < max_age and cached.get('id') == local['id']:
+            return None
+        digest = remote_digest(image)
+        cache[image] = {'id': local['id'], 'digest': digest, 'checked': now}
+        if digest and not any(d.endswith('@' + digest) for d in local['digests']):
+            return "newer version available"
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(images)), 1)) as pool:
+        reasons = dict(zip(images, pool.map(check, images)))
+    save_state(state)
+    return {image: reason for image, reason in reasons.items() if reason}
+
+def pull_images(images: List[str], workers: int) -> Dict[str, bool]:
+    """Pull images concurrently, printing combined layer progress as they go."""
+    lock = threading.Lock()
+    layers: Dict[str, Dict[str, bool]] = {image: {} for image in images}
+    finished: Dict[str, bool] = {}
+    last_report = [0.0]
+
+    def report(force: bool = False):
+        if not force and time.monotonic() - last_report[0] < 2:
+            return
+        last_report[0] = time.monotonic()
+        total = sum(len(found) for found in layers.values())
+        done = sum(sum(found.values()) for found in layers.values())
+        print(f"[INFO] Pulling: {len(finished)}/{len(images)} images, "
+              f"{done}/{total} layers complete")
+
+    def pull(image: str) -> bool:
+        started = time.monotonic()
+        process = subprocess.Popen([DOCKER, 'pull', image], stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, text=True)
+        for line in process.stdout:
+            layer, _, status = line.strip().partition(': ')
+            if len(layer) == 12 and all(c in '0123456789abcdef' for c in layer):
+                with lock:
+                    layers[image][layer] = status in ('Pull complete', 'Already exists')
+                    report()
+        ok = process.wait() == 0
+        with lock:
+            finished[image] = ok
+            if ok:
+                print_status(f"Pulled {image} in {time.monotonic() - started:.1f}s", "OK")
+            else:
+                print_status(f"Failed to pull {image}", "ERROR")
+        return ok
+
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(images)), 1)) as pool:
+        results = dict(zip(images, pool.map(pull, images)))
+    report(force=True)
+    return results
+
+def prepull_images(graph: Dict[str, Dict], services: List[str], workers: int = 4,
+                   max_age: float = 86400) -> None:
+    """Make sure every image the services need is present and current before starting."""
+    images = sorted({graph[name]['config']['image'] for name in services
+                     if graph[name]['config'].get('image')})
+    stale = images_to_pull(images, max_age, workers)
+    if not stale:
+        print_status(f"All {len(images)} images are current, skipping pull", "OK")
+        return
+    for image, reason in sorted(stale.items()):
+        print(f"[INFO] Pulling {image}: {reason}")
+    results = pull_images(sorted(stale), workers)
+    # Only remember freshly pulled images; failed ones are rechecked next run
+    state = load_state()
+    cache = state.setdefault('images', {})
+    for image, ok in results.items():
+        local = local_image(image) if ok else None
+        if local:
+            digests = [d.split('@', 1)[1] for d in local['digests'] if '@' in d]
+            cache[image] = {'id': local['id'], 'digest': digests[0] if digests else None,
+                            'checked': time.time()}
+        else:
+            cache.pop(image, None)
+    save_state(state)
+
+def image_id(image: Optional[str]) -> Optional[str]:
+    """Return the local ID of an image, or None if it hasn't been pulled."""
+    local = local_image(image) if image else None
+    return local['id'] if local else None
+
+def config_hash(info: Dict) -> str:
+    """Hash everything that should force a service to be recreated when it changes."""
+    # The rendered config already has the .env values interpolated
+    config = {key: value for key, value in info['config'].items() if key != 'depends_on'}
+    key = json.dumps([config, image_id(config.get('image'))], sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def load_state(path: str = STATE_FILE) -> Dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_state(state: Dict, path: str = STATE_FILE) -> None:
+    with open(path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+def plan_reconcile(graph: Dict[str, Dict], services: List[str],
+                   hashes: Dict[str, str]) -> Dict[str, Optional[str]]:
+    """Decide per service why it must be (re)started, or None to leave it running."""
+    stored = load_state().get('hashes', {})
+    with ThreadPoolExecutor(max_workers=max(len(services), 1)) as pool:
+        states = dict(zip(services, pool.map(service_state, services)))
+    plan = {}
+    for name in services:
+        state = states[name]
+        health = ((state or {}).get('Health') or {}).get('Status')
+        if state is None:
+            plan[name] = "not created"
+        elif stored.get(name) != hashes[name]:
+            plan[name] = "configuration or image changed"
+        elif health == 'unhealthy':
+            plan[name] = "unhealthy"
+        elif state.get('Status') == 'exited' and state.get('ExitCode') != 0:
+            plan[name] = f"exited with code {state.get('ExitCode')}"
+        elif not state.get('Running') and graph[name]['config'].get('restart'):
+            plan[name] = "not running"
+        else:
+            plan[name] = None
+    return plan
+
+def project_containers() -> Dict[str, List[str]]:
+    """Container ids of the project, by service, whatever profile created them."""
+    result = subprocess.run(
+        [DOCKER, 'ps', '-a', '--filter', f'label=com.docker.compose.project={PROJECT_NAME}',
+         '--format', '{{.ID}} {{.Label "com.docker.compose.service"}}'],
+        capture_output=True, text=True
+    )
+    containers: Dict[str, List[str]] = {}
+    for line in result.stdout.splitlines():
+        if len(line.split()) == 2:
+            container, service = line.split()
+            containers.setdefault(service, []).append(container)
+    return containers
+
+def remove_deselected(services: List[str]) -> None:
+    """Stop and remove containers of services that are no longer selected.
+
+    The graph only covers the active profiles, so the project's containers are
+    listed instead: an ollama-gpu left over after switching to the cpu profile
+    would otherwise keep the ollama name and port 11434 taken.
+    """
+    unwanted = {name: ids for name, ids in project_containers().items() if name not in services}
+    if unwanted:
+        print(f"[INFO] Removing deselected services: {', '.join(sorted(unwanted))}")
+        subprocess.run([DOCKER, 'rm', '-f'] + [c for ids in unwanted.values() for c in ids],
+                       capture_output=True, text=True)
+
+def start_service_graph(graph: Dict[str, Dict], services: List[str], profiles: List[str],
+                        timeout: float, probes: bool = True,
+                        keep: frozenset = frozenset()) -> Dict[str, Dict]:
+    """Start each service as soon as its dependencies are ready, in parallel.
+
+    Services in keep are already up to date and are only checked for readiness.
+    """
+    watcher = ReadinessWatcher(probes)
+    ready = {name: threading.Event() for name in services}
+    timings = {name: {} for name in services}
+    origin = time.monotonic()
+
+    def run(service: str):
+        info = graph[service]
+        timing = timings[service]
+        for dep, condition in info['depends_on'].items():
+            if dep not in ready:
+                continue
+            ready[dep].wait()
+            if not timings[dep].get('ok'):
+                print_status(f"Skipping {service}: {dep} is not ready", "WARN")
+                timing['skipped'] = True
+                ready[service].set()
+                return
+        timing['start'] = time.monotonic() - origin
+        try:
+            if service not in keep:
                 result = subprocess.run(
-                    ['docker', 'compose', '-p', 'localai', '-f', 'supabase/docker/docker-compose.yml', 'up', '-d', 'db'],
-                    env=env,
-                    check=True,
-                    capture_output=True,
-                    text=True
+                    compose_command(info['file'], profiles, 'up', '-d', '--no-deps',
+                                    '--force-recreate', service),
+                    env=compose_env(), capture_output=True, text=True
                 )
-                print(result.stdout)
-            except subprocess.CalledProcessError as e:
-                print(f"[ERROR] Database initialization fault: {e.stderr}")
-                print("[WARN] Continuing with backup protocols...")
+                if result.returncode != 0:
+                    print_status(f"Failed to start {service}: {result.stderr.strip()}", "ERROR")
+                    return
+            condition = ready_condition(graph, service, services)
+            service_timeout = SERVICE_TIMEOUTS.get(service, timeout)
+            timing['ok'] = watcher.wait(service, condition, service_timeout)
+            timing['ready'] = time.monotonic() - origin
+            if timing['ok']:
+                label = {'service_healthy': 'healthy', 'service_completed_successfully': 'completed'}
+                print_status(f"{service} {label.get(condition, 'started')} "
+                             f"after {timing['ready']:.1f}s", "OK")
+            else:
+                print_status(f"{service} did not become ready within {service_timeout:g}s", "ERROR")
+        finally:
+            ready[service].set()
 
-        # Start other services
-        print("[INFO] Launching AI core systems...")
-        services_to_start = []
-        for service in selected_services:
-            if service != 'supabase':
-                print(f"[INFO] Activating {service.title()}...")
-                services_to_start.append(service)
+    watcher.start()
+    try:
+        with ThreadPoolExecutor(max_workers=max(len(services), 1)) as pool:
+            list(pool.map(run, services))
+    finally:
+        watcher.stop()
+    return timings
+
+def print_critical_path(graph: Dict[str, Dict], timings: Dict[str, Dict]) -> None:
+    """Show the dependency chain that determined how long startup took."""
+    finished = {name: t for name, t in timings.items() if 'ready' in t}
+    if not finished:
+        return
+    print_section("STARTUP CRITICAL PATH")
+    path = [max(finished, key=lambda name: finished[name]['ready'])]
+    while True:
+        deps = [dep for dep in graph[path[-1]]['depends_on'] if dep in finished]
+        if not deps:
+            break
+        path.append(max(deps, key=lambda name: finished[name]['ready']))
+    for name in reversed(path):
+        t = finished[name]
+        print(f"  {name:<28} start {t['start']:6.1f}s  ready {t['ready']:6.1f}s  "
+              f"({t['ready'] - t['start']:.1f}s)")
+    busy = sum(t['ready'] - t['start'] for t in finished.values())
+    total = finished[path[0]]['ready']
+    print(f"\n  Total {total:.1f}s for {len(finished)} services "
+          f"({busy:.1f}s of service startup overlapped)")
+
+def format_size(size: float) -> str:
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+def ollama_api(path: str, payload: Optional[Dict] = None, timeout: float = 10) -> Dict:
+    """Call the Ollama HTTP API published on the host."""
+    data = json.dumps(payload).encode() if payload is not None else None
+    request = urllib.request.Request(OLLAMA_URL + path, data=data,
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read() or b'{}')
+
+def load_model_manifest(path: str = MODEL_MANIFEST) -> List[Dict]:
+    """Return the models every Ollama profile needs, with fully qualified names."""
+    with open(path) as f:
+        models = json.load(f)['models']
+    for model in models:
+        if ':' not in model['name'].rsplit('/', 1)[-1]:
+            model['name'] += ':latest'
+    return models
+
+def manifest_path(model: str) -> str:
+    """Where Ollama keeps a model's manifest, relative to its models directory."""
+    name, _, tag = model.rpartition(':')
+    parts = name.split('/')
+    if len(parts) == 1:
+        parts.insert(0, 'library')
+    if len(parts) == 2:
+        parts.insert(0, 'registry.ollama.ai')
+    return '/'.join(['manifests'] + parts + [tag])
+
+def blob_path(digest: str) -> str:
+    return 'blobs/' + digest.replace(':', '-')
+
+class ModelStore:
+    """Ollama's content-addressed models directory, in a container or on the host."""
+
+    def __init__(self, container: Optional[str] = None):
+        self.container = container
+        # Without a container Ollama runs natively, e.g. with --profile none on a Mac
+        self.root = OLLAMA_MODELS_DIR if container else os.environ.get(
+            'OLLAMA_MODELS', os.path.join(os.path.expanduser('~'), '.ollama', 'models'))
 
-        if services_to_start:
+    def shell(self, script: str, *paths: str) -> str:
+        """Run a shell script in the models directory of the container."""
+        result = subprocess.run([DOCKER, 'exec', self.container, 'sh', '-c',
+                                 f'cd "{self.root}" && {script}', 'sh', *paths],
+                                capture_output=True, text=True)
+        return result.stdout
+
+    def read(self, path: str) -> Optional[str]:
+        if self.container:
+            return self.shell('cat "$1" 2>/dev/null', path) or None
+        try:
+            with open(os.path.join(self.root, path)) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def stat(self, paths: List[str]) -> Dict[str, List[int]]:
+        """Return the size and modification time of each path that exists."""
+        found = {}
+        if self.container:
+            for line in self.shell('stat -c "%s %Y %n" "$@" 2>/dev/null', *paths).splitlines():
+                size, mtime, path = line.split(' ', 2)
+                found[path] = [int(size), int(mtime)]
+            return found
+        for path in paths:
             try:
-                # Set environment variables explicitly
-                env = os.environ.copy()
-                env.update({
-                    'POSTGRES_PASSWORD': os.getenv('POSTGRES_PASSWORD', 'postgres'),
-                    'REDIS_PASSWORD': os.getenv('REDIS_PASSWORD', 'redis'),
-                    'tmp': '/tmp'  # Add the missing tmp variable
-                })
-                
-                # Build the docker compose command
-                cmd = ['docker', 'compose', '-p', 'localai', '-f', 'docker-compose.yml', 'up', '-d']
-                cmd.extend(services_to_start)
-                
-                result = subprocess.run(
-                    cmd,
-                    env=env,
-                    check=True,
-                    capture_output=True,
-                    text=True
-                )
-                print(result.stdout)
-            except subprocess.CalledProcessError as e:
-                print(f"[ERROR] Critical system failure: {e.stderr}")
+                info = os.stat(os.path.join(self.root, path))
+            except OSError:
+                continue
+            found[path] = [info.st_size, int(info.st_mtime)]
+        return found
+
+    def sha256(self, paths: List[str]) -> Dict[str, str]:
+        if self.container:
+            output = self.shell('sha256sum "$@" 2>/dev/null', *paths)
+            return {line.split()[1]: line.split()[0] for line in output.splitlines()}
+        hashes = {}
+        for path in paths:
+            digest = hashlib.sha256()
+            with open(os.path.join(self.root, path), 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            hashes[path] = digest.hexdigest()
+        return hashes
+
+    def remove(self, paths: List[str]) -> None:
+        if self.container:
+            self.shell('rm -f "$@"', *paths)
+            return
+        for path in paths:
+            try:
+                os.remove(os.path.join(self.root, path))
+            except OSError:
+                pass
+
+    def usage(self) -> Dict[str, Optional[int]]:
+        """Bytes used by the models directory and free on its filesystem."""
+        if self.container:
+            used = self.shell('du -sk . 2>/dev/null').split()
+            free = self.shell('df -Pk . 2>/dev/null').splitlines()[1:]
+            return {'used': int(used[0]) * 1024 if used else None,
+                    'free': int(free[0].split()[3]) * 1024 if free else None}
+        used = 0
+        for folder, _, files in os.walk(self.root):
+            used += sum(os.path.getsize(os.path.join(folder, name)) for name in files)
+        return {'used': used, 'free': shutil.disk_usage(self.root).free}
+
+def model_blobs(store: ModelStore, model: str) -> Optional[Dict[str, Optional[int]]]:
+    """Return the digest and expected size of every blob a model is made of."""
+    text = store.read(manifest_path(model))
+    try:
+        manifest = json.loads(text) if text else None
+    except ValueError:
+        return None
+    if not manifest:
+        return None
+    entries = [manifest.get('config')] + manifest.get('layers', [])
+    return {entry['digest']: entry.get('size') for entry in entries if entry}
+
+def check_model(store: ModelStore, model: str, verified: Dict[str, int]) -> Optional[str]:
+    """Return why a model has to be pulled, or None if its blobs are all intact.
+
+    Blobs are named after their sha256, so a blob that hashes to its name once
+    stays good until its file changes; verified maps digests to the mtime at
+    which they were last checked so repeat runs only stat them.
+    """
+    blobs = model_blobs(store, model)
+    if blobs is None:
+        return "not in the model store"
+    paths = {digest: blob_path(digest) for digest in blobs}
+    found = store.stat(list(paths.values()))
+    missing = [digest for digest, path in paths.items()
+               if path not in found or blobs[digest] not in (None, found[path][0])]
+    if missing:
+        return f"{len(missing)} of {len(blobs)} blobs missing or incomplete"
+    unchecked = [digest for digest, path in paths.items() if verified.get(digest) != found[path][1]]
+    if unchecked:
+        hashes = store.sha256([paths[digest] for digest in unchecked])
+        corrupt = [digest for digest in unchecked
+                   if 'sha256:' + hashes.get(paths[digest], '') != digest]
+        if corrupt:
+            # Ollama trusts blobs that are already there, so drop them before pulling
+            store.remove([paths[digest] for digest in corrupt])
+            return f"{len(corrupt)} blobs failed digest verification"
+        for digest in unchecked:
+            verified[digest] = found[paths[digest]][1]
+    return None
+
+def pull_models(models: List[str], workers: int) -> Dict[str, bool]:
+    """Pull models through the Ollama API, printing combined download progress."""
+    lock = threading.Lock()
+    progress: Dict[str, Dict[str, List[int]]] = {model: {} for model in models}
+    finished: Dict[str, bool] = {}
+    last_report = [0.0]
+
+    def report(force: bool = False):
+        if not force and time.monotonic() - last_report[0] < 2:
+            return
+        last_report[0] = time.monotonic()
+        done = sum(c for blobs in progress.values() for c, _ in blobs.values())
+        total = sum(t for blobs in progress.values() for _, t in blobs.values())
+        print(f"[INFO] Pulling models: {len(finished)}/{len(models)} done, "
+              f"{format_size(done)} of {format_size(total)}")
+
+    def pull(model: str) -> bool:
+        started = time.monotonic()
+        ok = False
+        request = urllib.request.Request(
+            f"{OLLAMA_URL}/api/pull", data=json.dumps({'model': model, 'stream': True}).encode(),
+            headers={'Content-Type': 'application/json'}
+        )
+        try:
+            # The timeout applies to each read, so only a stalled download trips it
+            with urllib.request.urlopen(request, timeout=300) as response:
+                for line in response:
+                    update = json.loads(line)
+                    if 'error' in update:
+                        raise ValueError(update['error'])
+                    if update.get('digest') and update.get('total'):
+                        with lock:
+                            progress[model][update['digest']] = [update.get('completed', 0),
+                                                                 update['total']]
+                            report()
+                    ok = update.get('status') == 'success'
+            error = None if ok else "download ended early"
+        except (OSError, ValueError) as e:
+            error = str(e)
+        with lock:
+            finished[model] = ok
+            if ok:
+                print_status(f"Pulled {model} in {time.monotonic() - started:.1f}s", "OK")
+            else:
+                print_status(f"Failed to pull {model}: {error}", "ERROR")
+        return ok
+
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(models)), 1)) as pool:
+        results = dict(zip(models, pool.map(pull, models)))
+    report(force=True)
+    return results
+
+def print_model_store(store: ModelStore, models: List[str]) -> None:
+    """Report the size of each required model and of the store as a whole."""
+    try:
+        sizes = {m['name']: m.get('size') for m in ollama_api('/api/tags').get('models', [])}
+    except (OSError, ValueError):
+        sizes = {}
+    for model in models:
+        size = sizes.get(model)
+        print(f"  {model:<40} {format_size(size) if size else 'missing':>10}")
+    usage = store.usage()
+    location = "ollama-data volume" if store.container else store.root
+    print(f"  Model store ({location}): {len(sizes)} models, "
+          f"{format_size(usage['used']) if usage['used'] is not None else 'unknown size'} used, "
+          f"{format_size(usage['free']) if usage['free'] is not None else 'unknown'} free")
+
+def provision_models(store: ModelStore, workers: int = 4) -> bool:
+    """Make sure every model in the manifest is in the store and intact."""
+    models = [model['name'] for model in load_model_manifest()]
+    state = load_state()
+    verified = state.setdefault('blobs', {})
+    with ThreadPoolExecutor(max_workers=max(len(models), 1)) as pool:
+        reasons = dict(zip(models, pool.map(lambda model: check_model(store, model, verified), models)))
+    save_state(state)
+    stale = sorted(model for model, reason in reasons.items() if reason)
+    results = {}
+    if stale:
+        for model in stale:
+            print(f"[INFO] Pulling {model}: {reasons[model]}")
+        results = pull_models(stale, workers)
+        # Ollama checks each blob's digest as it downloads, so these count as verified
+        state = load_state()
+        verified = state.setdefault('blobs', {})
+        for model in (model for model, ok in results.items() if ok):
+            blobs = model_blobs(store, model) or {}
+            found = store.stat([blob_path(digest) for digest in blobs])
+            for digest in blobs:
+                if blob_path(digest) in found:
+                    verified[digest] = found[blob_path(digest)][1]
+        save_state(state)
+    else:
+        print_status(f"All {len(models)} models present and verified, skipping pull", "OK")
+    print_model_store(store, models)
+    return all(results.values())
+
+def wait_for_ollama(timeout: float = 60) -> bool:
+    """Poll the Ollama API until it answers or the timeout passes."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            ollama_api('/api/version', timeout=2)
+            return True
+        except (OSError, ValueError):
+            if time.monotonic() >= deadline:
                 return False
+            time.sleep(0.5)
+
+def keep_alive_arg(value: str) -> str:
+    """Accept what both the API and OLLAMA_KEEP_ALIVE take: seconds or a Go duration."""
+    if not re.fullmatch(r'-?\d+|-?(\d+(\.\d+)?(ns|us|µs|ms|s|m|h))+', value):
+        raise argparse.ArgumentTypeError(f"'{value}' is neither seconds nor a duration like 30m or 1h30m")
+    return value
+
+def keep_alive_value(keep_alive: str) -> Union[int, str]:
+    """The API parses strings as durations, so a bare number of seconds must go as a number."""
+    return int(keep_alive) if re.fullmatch(r'-?\d+', keep_alive) else keep_alive
+
+def warm_model(model: Dict, keep_alive: str) -> Dict:
+    """Load a model and keep it resident, timing the first token or embedding."""
+    started = time.monotonic()
+    result = {'name': model['name'], 'ok': False}
+    response = {}
+    try:
+        if model.get('role') == 'embedding':
+            response = ollama_api('/api/embed', {'model': model['name'], 'input': 'warm up',
+                                                 'keep_alive': keep_alive_value(keep_alive)},
+                                  timeout=300)
+            result['first_token'] = time.monotonic()
+        else:
+            payload = {'model': model['name'], 'prompt': 'Hello', 'stream': True,
+                       'keep_alive': keep_alive_value(keep_alive), 'options': {'num_predict': 1}}
+            request = urllib.request.Request(f"{OLLAMA_URL}/api/generate",
+                                             data=json.dumps(payload).encode(),
+                                             headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(request, timeout=300) as stream:
+                for line in stream:
+                    response = json.loads(line)
+                    result.setdefault('first_token', time.monotonic())
+        if 'error' in response:
+            raise ValueError(response['error'])
+        result['ok'] = True
+        # Ollama reports how long loading the weights took, in nanoseconds
+        result['load'] = response.get('load_duration', 0) / 1e9
+    except (OSError, ValueError) as e:
+        result['error'] = str(e)
+    result['seconds'] = time.monotonic() - started
+    return result
+
+def warm_models(keep_alive: str, profiler: PhaseProfiler) -> bool:
+    """Load the manifest's models in parallel and check that they stay resident."""
+    models = load_model_manifest()
+    with ThreadPoolExecutor(max_workers=max(len(models), 1)) as pool:
+        results = list(pool.map(lambda model: warm_model(model, keep_alive), models))
+    for result in results:
+        if result['ok']:
+            print_status(f"Warmed {result['name']} in {result['seconds']:.1f}s "
+                         f"(loading took {result['load']:.1f}s)", "OK")
+        else:
+            print_status(f"Failed to warm {result['name']}: {result['error']}", "ERROR")
+
+    try:
+        loaded = {m['name']: m for m in ollama_api('/api/ps').get('models', [])}
+    except (OSError, ValueError):
+        loaded = {}
+    resident = True
+    for model in models:
+        info = loaded.get(model['name'])
+        if info is None:
+            print_status(f"{model['name']} is not resident after warming", "WARN")
+            resident = False
+            continue
+        size = info.get('size') or 0
+        gpu = f", {info.get('size_vram', 0) / size:.0%} on GPU" if size else ""
+        print(f"  {model['name']:<40} {format_size(size):>10} resident{gpu}, "
+              f"until {info.get('expires_at', 'unknown')}")
+
+    chat = [r['first_token'] for r, m in zip(results, models)
+            if r['ok'] and m.get('role') != 'embedding']
+    if chat:
+        # profiler.started excludes the prompts, so this is time the user actually waited
+        first_token = min(chat) - profiler.started
+        profiler.record('first_warm_token', first_token)
+        print_status(f"First warm token {first_token:.1f}s after start_services.py started", "INFO")
+    return resident and all(r['ok'] for r in results)
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)]
 
-        return True
+def timed_generate(model: str, prompt: str, options: Dict) -> Dict:
+    """Run one non-streaming generation and return its latency and token count."""
+    started = time.monotonic()
+    try:
+        response = ollama_api('/api/generate', {
+            'model': model, 'prompt': prompt, 'stream': False,
+            'options': {'num_predict': TUNE_TOKENS, 'temperature': 0, 'seed': 42, **options},
+        }, timeout=600)
+    except (OSError, ValueError):
+        response = {'error': 'request failed'}
+    return {'latency': time.monotonic() - started, 'tokens': response.get('eval_count', 0),
+            'ok': 'error' not in response}
+
+def run_workload(chat: str, embedding: Optional[str], options: Dict) -> Dict:
+    """Drive the fixed prompt set at each concurrency level, with embeddings alongside."""
+    levels = {}
+    for level in TUNE_CONCURRENCY:
+        prompts = [TUNE_PROMPTS[i % len(TUNE_PROMPTS)] for i in range(level * 2)]
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=level + 1) as pool:
+            # RAG chats embed the question too, which is what makes the number of
+            # loaded models matter
+            if embedding:
+                pool.submit(ollama_api, '/api/embed', {'model': embedding, 'input': prompts},
+                            timeout=600)
+            results = list(pool.map(lambda prompt: timed_generate(chat, prompt, options), prompts))
+        wall = time.monotonic() - started
+        latencies = [r['latency'] for r in results if r['ok']]
+        levels[str(level)] = {
+            'tokens_per_s': round(sum(r['tokens'] for r in results) / wall, 2) if wall else 0.0,
+            'p95_latency_s': round(percentile(latencies, 0.95), 2),
+            'errors': sum(not r['ok'] for r in results),
+            'wall_s': round(wall, 2),
+        }
+    return levels
+
+def apply_ollama_settings(service: str, profiles: List[str], settings: Dict[str, str]) -> bool:
+    """Recreate the Ollama service with the given server settings in the override."""
+    write_override(COMPOSE_FILES[0], {name: {'environment': settings} for name in OLLAMA_SERVICES})
+    result = subprocess.run(
+        compose_command(COMPOSE_FILES[0], profiles, 'up', '-d', '--no-deps', '--force-recreate', service),
+        env=compose_env(), capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        print_status(f"Failed to restart {service}: {result.stderr.strip()}", "ERROR")
+        return False
+    return wait_for_ollama(180)
+
+def tune_ollama(profile: str = 'cpu') -> bool:
+    """Sweep Ollama's server settings on this machine and keep the fastest.
+
+    Trying every combination would take hours on a CPU, so one setting is
+    varied at a time while the others stay at the best value found so far.
+    """
+    print_section("OLLAMA TUNING")
+    profiles = [] if profile == 'none' else [profile]
+    graph = load_service_graph(profiles)
+    service = next((name for name in OLLAMA_SERVICES if name in graph), None)
+    if service is None:
+        print_status(f"No Ollama service runs with profile {profile}", "ERROR")
+        return False
+    if not wait_for_ollama(10):
+        print_status(f"Ollama is not answering on {OLLAMA_URL}; start the stack first", "ERROR")
+        return False
+    roles = {model.get('role'): model['name'] for model in load_model_manifest()}
+    installed = {m['name'] for m in ollama_api('/api/tags').get('models', [])}
+    chat = roles.get('chat')
+    embedding = roles.get('embedding') if roles.get('embedding') in installed else None
+    if chat not in installed:
+        print_status(f"{chat} is not installed; run start_services.py first", "ERROR")
+        return False
+
+    override = TUNING_OVERRIDES[COMPOSE_FILES[0]]
+    original = open(override).read() if os.path.exists(override) else None
+    cpus = docker_resources()['cpus']
+    dimensions = [
+        [{},
+         {'OLLAMA_FLASH_ATTENTION': '1', 'OLLAMA_KV_CACHE_TYPE': 'f16'},
+         {'OLLAMA_FLASH_ATTENTION': '1', 'OLLAMA_KV_CACHE_TYPE': 'q8_0'}],
+        [{'OLLAMA_NUM_PARALLEL': str(n)} for n in (1, 2, 4)],
+        # Two keeps the chat and embedding models resident together
+        [{'OLLAMA_MAX_LOADED_MODELS': str(n)} for n in (2, 1)],
+    ]
+    trials: List[Dict] = []
+    measured: Dict[str, Dict] = {}
+
+    def trial(settings: Dict[str, str], options: Dict) -> Dict:
+        key = json.dumps([settings, options], sort_keys=True)
+        if key not in measured:
+            if not options and not apply_ollama_settings(service, profiles, settings):
+                raise RuntimeError("Ollama did not come back after changing its settings")
+            # Load outside the measurement, as start_services.py does at startup
+            timed_generate(chat, TUNE_PROMPTS[0], options)
+            levels = run_workload(chat, embedding, options)
+            record = {'settings': settings, 'options': options, 'levels': levels,
+                      'tokens_per_s': round(statistics.mean(l['tokens_per_s'] for l in levels.values()), 2),
+                      'errors': sum(l['errors'] for l in levels.values())}
+            described = ' '.join(f"{k.replace('OLLAMA_', '').lower()}={v}"
+                                 for k, v in {**settings, **options}.items()) or 'defaults'
+            p95 = '/'.join(f"{l['p95_latency_s']:.1f}s" for l in levels.values())
+            print(f"  {described:<70} {record['tokens_per_s']:7.2f} tok/s  p95 {p95}")
+            trials.append(record)
+            measured[key] = record
+        return measured[key]
+
+    def fastest(candidates: List, measure) -> Dict:
+        """The first candidate, unless a later one is clearly faster than the best so far."""
+        best = candidates[0]
+        for candidate in candidates[1:]:
+            current, record = measure(best), measure(candidate)
+            if not record['errors'] and (current['errors'] or record['tokens_per_s'] >
+                                         current['tokens_per_s'] * (1 + TUNE_MIN_GAIN)):
+                best = candidate
+        return best
+
+    finished = False
+    try:
+        print(f"[INFO] Tuning {chat} at concurrency {', '.join(map(str, TUNE_CONCURRENCY))}; "
+              f"every trial restarts {service}")
+        baseline = trial({}, {})
+        best = {}
+        for choices in dimensions:
+            best = fastest([{**best, **choice} for choice in choices],
+                           lambda settings: trial(settings, {}))
+        # Threads are a per-request option, so they are measured without restarting
+        apply_ollama_settings(service, profiles, best)
+        threads = fastest([{}] + [{'num_thread': n} for n in sorted({max(cpus // 2, 1), cpus})],
+                          lambda options: trial(best, options))
+        winner = trial(best, threads)
+        finished = True
+    except RuntimeError as e:
+        print_status(str(e), "ERROR")
+        return False
+    finally:
+        if not finished:
+            print_status("Tuning stopped; restoring the previous Ollama settings", "WARN")
+            if original is None:
+                # Not written yet if tuning stopped before the first restart
+                if os.path.exists(override):
+                    os.remove(override)
+            else:
+                with open(override, 'w') as f:
+                    f.write(original)
+            subprocess.run(compose_command(COMPOSE_FILES[0], profiles, 'up', '-d', '--no-deps',
+                                           '--force-recreate', service),
+                           env=compose_env(), capture_output=True, text=True)
+
+    with open(OLLAMA_TUNING_REPORT, 'w') as f:
+        json.dump({'time': datetime.now().isoformat(timespec='seconds'), 'host': host_resources(),
+                   'service': service, 'chat_model': chat, 'embedding_model': embedding,
+                   'concurrency': TUNE_CONCURRENCY, 'prompt_tokens': TUNE_TOKENS,
+                   'baseline': baseline, 'best': winner, 'trials': trials}, f, indent=2)
+    change = (winner['tokens_per_s'] / baseline['tokens_per_s'] - 1) * 100 if baseline['tokens_per_s'] else 0.0
+    print_status(f"Best: {winner['tokens_per_s']:.2f} tok/s against {baseline['tokens_per_s']:.2f} "
+                 f"with Ollama's defaults ({change:+.0f}%)", "OK")
+    for key, value in best.items():
+        print(f"  {key:<42} {value}")
+    print(f"[INFO] Settings written to {override}, full results in {OLLAMA_TUNING_REPORT}")
+    if threads:
+        # Ollama has no server-wide setting for this, so it can't go in the override
+        print_status(f"num_thread={threads['num_thread']} was fastest; set it in the model "
+                     f"options of your workflows to use it", "INFO")
+    return True
+
+def start_services(selected_services: Dict[str, bool], use_cloudflare: bool = False,
+                   profile: str = 'cpu', timeout: float = 300, probes: bool = True,
+                   profiler: Optional[PhaseProfiler] = None, fresh: bool = False,
+                   pull_workers: int = 4, pull_interval: float = 86400,
+                   models: bool = True, keep_alive: str = '24h') -> bool:
+    """Bring the selected services up to date in dependency order.
+
+    Running services whose configuration and image are unchanged are left alone
+    unless fresh is set, which stops the whole stack first. With models set, the
+    Ollama models in the manifest are then checked, pulled if needed and loaded
+    so they stay resident for keep_alive.
+    """
+    profiler = profiler or PhaseProfiler()
+    # Also the default for requests that don't set one, e.g. from n8n
+    os.environ['OLLAMA_KEEP_ALIVE'] = keep_alive
+    try:
+        # Ensure .env file exists and copy it to supabase/docker/.env
+        if os.path.exists('.env'):
+            shutil.copy2('.env', 'supabase/docker/.env')
+        else:
+            print("[ERROR] .env file not found. Please run the script again to generate it.")
+            return False
+
+        if fresh:
+            with profiler.phase('compose_down'):
+                for compose_file in COMPOSE_FILES:
+                    if os.path.exists(compose_file):
+                        subprocess.run(compose_command(compose_file, [], 'down'), env=compose_env())
+
+        profiles = [] if profile == 'none' else [profile]
+        if use_cloudflare:
+            selected_services = {**selected_services, "Cloudflared (Secure Access)": True}
+            profiles.append('cloudflared')
+
+        print("[INFO] Mapping service dependency graph...")
+        with profiler.phase('compose_config'):
+            graph = load_service_graph(profiles)
+        services = resolve_services(selected_services, graph)
+        if models:
+            services = [name for name in services if name not in OLLAMA_PULLERS]
+        profiler.services = services
+
+        # Pull before hashing so that updated images get their services recreated
+        if pull_workers > 0:
+            with profiler.phase('image_pull'):
+                prepull_images(graph, services, pull_workers, pull_interval)
+
+        with profiler.phase('reconcile'):
+            remove_deselected(services)
+            with ThreadPoolExecutor(max_workers=max(len(services), 1)) as pool:
+                hashes = dict(zip(services, pool.map(lambda name: config_hash(graph[name]), services)))
+            plan = plan_reconcile(graph, services, hashes)
+        keep = frozenset(name for name, reason in plan.items() if reason is None)
+        for name, reason in sorted(plan.items()):
+            if reason:
+                print(f"[INFO] Starting {name}: {reason}")
+        if keep:
+            print(f"[INFO] Unchanged and left running: {', '.join(sorted(keep))}")
+        for number, wave in enumerate(start_waves(graph, services), 1):
+            print(f"[INFO] Wave {number}: {', '.join(wave)}")
+
+        print("[INFO] Launching AI core systems...")
+        with profiler.phase('compose_up'):
+            timings = start_service_graph(graph, services, profiles, timeout, probes, keep)
+        state = load_state()
+        state['hashes'] = {
+            **state.get('hashes', {}),
+            **{name: hashes[name] for name in services if timings[name].get('ok')},
+        }
+        for name in services:
+            if not timings[name].get('ok'):
+                state['hashes'].pop(name, None)
+        save_state(state)
+        for name, t in timings.items():
+            if 'ready' in t:
+                profiler.record(f"service:{name}", t['ready'] - t['start'])
+        print_critical_path(graph, timings)
+        ok = all(t.get('ok') for t in timings.values())
+
+        ollama = next((name for name in OLLAMA_SERVICES if name in services), None)
+        if models and ollama and timings[ollama].get('ok'):
+            store = ModelStore(service_container(ollama))
+        elif models and profile == 'none' and selected_services.get("Ollama (Local LLM)"):
+            store = ModelStore()
+        else:
+            store = None
+        if store is not None:
+            print_section("MODEL STORE")
+            with profiler.phase('model_store'):
+                if not wait_for_ollama():
+                    print_status(f"Ollama is not answering on {OLLAMA_URL}, skipping models", "WARN")
+                    return False
+                ok = provision_models(store, max(pull_workers, 1)) and ok
+            with profiler.phase('model_warm'):
+                ok = warm_models(keep_alive, profiler) and ok
+        return ok
     except Exception as e:
         print(f"[ERROR] System initialization failed: {str(e)}")
         return False
@@ -458,30 +1851,88 @@ def check_dependencies():
         subprocess.run([sys.executable, "-m", "pip", "install", "PyJWT", "cryptography"], check=True)
 
 def main():
-    print_banner()
     parser = argparse.ArgumentParser(description='Initialize the local AI neural matrix.')
     parser.add_argument('--profile', choices=['cpu', 'gpu-nvidia', 'gpu-amd', 'none'], default='cpu',
                       help='Neural processing unit selection (default: cpu)')
+    parser.add_argument('--health-timeout', type=float, default=300,
+                      help='Seconds to wait for each service to become ready (default: 300)')
+    parser.add_argument('--no-probes', action='store_true',
+                      help="Rely on Docker healthchecks only, without active readiness probes")
+    parser.add_argument('--fresh', action='store_true',
+                      help='Stop every container before starting, instead of only restarting what changed')
+    parser.add_argument('--pull-workers', type=int, default=4,
+                      help='Images to pull at once before starting, 0 to skip pre-pulling (default: 4)')
+    parser.add_argument('--pull-interval', type=float, default=24,
+                      help='Hours between registry checks for newer images (default: 24)')
+    parser.add_argument('--no-models', action='store_true',
+                      help=f'Skip checking, pulling and warming the Ollama models listed in {MODEL_MANIFEST}')
+    parser.add_argument('--keep-alive', default='24h', type=keep_alive_arg,
+                      help='How long Ollama keeps models loaded after use, e.g. 30m or -1 for ever (default: 24h)')
+    parser.add_argument('--tune-only', action='store_true',
+                      help='Re-derive the Postgres, Supavisor and Redis tuning in .env for this '
+                           'machine, leaving secrets untouched, and exit')
+    parser.add_argument('--tune-ollama', action='store_true',
+                      help=f"Benchmark Ollama's server settings on this machine, keep the fastest "
+                           f"and write the results to {OLLAMA_TUNING_REPORT}, then exit")
+    parser.add_argument('--timings', action='store_true',
+                      help=f'Compare the latest startup with earlier ones from {TIMINGS_LOG} and exit')
     args = parser.parse_args()
 
-    print_section("SYSTEM DIAGNOSTICS")
-    check_dependencies()
-    
-    if not os.path.exists(".env"):
-        print_status("Generating quantum encryption keys...", "INFO")
-        setup_environment()
-    
-    print_status("Establishing neural links...", "INFO")
-    clone_supabase()
-    prepare_supabase_env()
-    
-    print_status("Configuring search matrix...", "INFO")
-    setup_searxng()
-    
-    use_cloudflared = setup_cloudflared()
-    
-    selected_services = select_services()
-    start_services(selected_services, use_cloudflared)
+    if args.timings:
+        print_timings_report()
+        return
+    if args.tune_only:
+        print_section("HARDWARE TUNING")
+        if not os.path.exists('.env'):
+            print_status(".env not found; run start_services.py once to create it", "ERROR")
+            sys.exit(1)
+        tune_for_host()
+        print("[INFO] Run start_services.py again to apply; only the tuned services are recreated")
+        return
+    if args.tune_ollama:
+        sys.exit(0 if tune_ollama(args.profile) else 1)
+
+    print_banner()
+    profiler = PhaseProfiler()
+    profiler.profile = args.profile
+    try:
+        print_section("SYSTEM DIAGNOSTICS")
+        with profiler.phase('check_dependencies'):
+            check_dependencies()
+
+        fresh_env = not os.path.exists(".env")
+        if fresh_env:
+            print_status("Generating quantum encryption keys...", "INFO")
+            with profiler.phase('setup_environment'):
+                setup_environment()
+
+        print_status("Establishing neural links...", "INFO")
+        with profiler.phase('clone_supabase'):
+            clone_supabase()
+        with profiler.phase('prepare_supabase_env'):
+            prepare_supabase_env()
+        if fresh_env:
+            # Only now does the Supabase compose file define db for the override
+            with profiler.phase('tune_for_host'):
+                tune_for_host()
+
+        print_status("Configuring search matrix...", "INFO")
+        with profiler.phase('setup_searxng'):
+            setup_searxng()
+
+        # Prompts are left out of the timings: they measure the user, not the stack
+        with profiler.paused():
+            use_cloudflared = setup_cloudflared()
+            selected_services = select_services()
+
+        start_services(selected_services, use_cloudflared, args.profile, args.health_timeout,
+                       not args.no_probes, profiler, args.fresh,
+                       args.pull_workers, args.pull_interval * 3600, not args.no_models,
+                       args.keep_alive)
+    finally:
+        # Runs abandoned at a prompt would only skew the medians
+        if profiler.failed or profiler.services:
+            profiler.save()
 
 if __name__ == "__main__":
     try: